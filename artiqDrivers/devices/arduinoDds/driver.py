@@ -2,6 +2,9 @@ import time
 import serial
 import logging
 
+from artiqDrivers.devices.dds_base import DdsBase
+from artiqDrivers.devices.dds_conversion import DdsConversion
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,54 +20,103 @@ def _write_exactly(f, data):
 
 
 
-class ArduinoDds:
-    lsbAmp = 1.0 / 16383 # 0x3fff is maximum amplitude
-    lsbPhase = 360.0 / 65536 # Degrees per LSB.
+class ArduinoDds(DdsBase):
+    # Size of the Arduino serial receive buffer. Commands are sent in chunks
+    # which fit in it, each followed by an identity query as acknowledgement,
+    # so that the buffer can never overflow
+    rxBufferSize = 64
   
-    def __init__(self, addr, clockFreq):
+    def __init__(self, addr, clockFreq, bootTimeout=10.0):
         # addr : serial port name
         # clockFreq : clock frequency in Hz
+        # bootTimeout : time to wait for the Arduino to boot, in seconds
         
         self.ser = serial.Serial(addr, baudrate=115200)
-        self.lsbFreq = clockFreq / (2**32);
-        self.clockFreq = clockFreq
-        time.sleep(5)
+        DdsBase.__init__(self, clockFreq)
+        self._waitForBoot(bootTimeout)
         logger.info("Connected to ArduinoDDS with ID '{}'".format(self.identity()))
+
+    def _waitForBoot(self, timeout, pollInterval=0.1):
+        """Opening the port resets the Arduino. Poll the identity until the
+        firmware answers, rather than waiting for a fixed time"""
+        t_start = time.time()
+        self.ser.timeout = pollInterval
+        try:
+            while True:
+                self.send("*IDN?\n")
+                if self.ser.readline().strip():
+                    break
+                if time.time() - t_start > timeout:
+                    raise IOError("ArduinoDDS did not respond within {}s".format(timeout))
+        finally:
+            self.ser.timeout = None
+        # Drop any answers to earlier polls which arrived late
+        time.sleep(pollInterval)
+        self.ser.reset_input_buffer()
+        logger.debug("ArduinoDDS ready after {:.2f}s".format(time.time() - t_start))
     
     
     def send(self, data):
         self.ser.write(data.encode())
 
     
-    def setProfile(self, profile, freq, phase=0.0, amp=1.0):
+    def setProfile(self, profile, freq, phase=0.0, amp=1.0, force=False):
         """Sets a DDS profile frequency (Hz), phase (degrees), and amplitude (full-scale).
-        phase defaults to 0 and amplitude defaults to 1"""
-        if amp < 0 or amp > 1:
-            raise ValueError("DDS amplitude must be between 0 and 1")
-        if freq < 0 or freq > 450e6: # This should be dependant on the clock frequency
-            raise ValueError("DDS frequency must be between 0 and 450 MHz")
-        
-        ampWord = int(round( amp / self.lsbAmp ))
-        phaseWord = int(round( (phase % 360.0) / self.lsbPhase ))
-        freqWord = int(round( freq / self.lsbFreq ))
-        self.setProfileLSB(profile, freqWord, phaseWord, ampWord)
+        phase defaults to 0 and amplitude defaults to 1.
+        The write is skipped if the profile already holds the same words, unless
+        force is True. Returns True if the profile was written"""
+        freqWord, phaseWord, ampWord = self.conversion.toWords(freq, phase, amp)
+        return self.setProfileLSB(profile, freqWord, phaseWord, ampWord, force=force)
         
     
-    def setProfileLSB(self, profile, freq, phase, amp): # Freq, phase, amp are all in units of lsb
-        if profile < 0 or profile > 7 or not isinstance(profile, int):
-            raise ValueError("DDS profile should be an integer between 0 and 7")
-        if amp > 0x3fff or amp < 0 or not isinstance(amp, int):
-            raise ValueError("DDS amplitude word should be an integer between 0 and 0x3fff")
-        if phase > 0xffff or phase < 0 or not isinstance(phase, int):
-            raise ValueError("DDS phase word should be an integer between 0 and 0xffff")
-        if freq < 0 or freq > 0xffffffff or not isinstance(freq, int):
-            raise ValueError("DDS frequency word should be an integer between 0 and 0xffffffff")
-        
-        self.send('PLSB {} {} {} {}\n'.format( profile, amp, phase, freq) );
-        time.sleep(0.01)
+    def setProfileLSB(self, profile, freq, phase, amp, force=False): # Freq, phase, amp are all in units of lsb
+        return self.setProfilesLSB([(profile, freq, phase, amp)], force=force) > 0
+
+    def setProfiles(self, entries, force=False):
+        """Sets several DDS profiles, given as (profile, freq, phase, amp) tuples
+        with freq in Hz, phase in degrees and amp in full-scale, see
+        setProfilesLSB. Returns the number of profiles written"""
+        words = []
+        for (profile, freq, phase, amp) in entries:
+            words.append((profile,) + self.conversion.toWords(freq, phase, amp))
+        return self.setProfilesLSB(words, force=force)
+
+    def setProfilesLSB(self, entries, force=False):
+        """Sets several DDS profiles, given as (profile, freq, phase, amp) tuples
+        in units of lsb. The whole table is validated first, profiles which
+        already hold the requested words are skipped unless force is True, and
+        the rest are sent back-to-back, waiting for an acknowledgement only
+        when the Arduino receive buffer would otherwise overflow.
+        Returns the number of profiles written"""
+        return self._writeProfiles([(0,) + tuple(entry) for entry in entries],
+                                   force=force)
+
+    def _profileCommand(self, channel, profile, freq, phase, amp):
+        return 'PLSB {} {} {} {}\n'.format(profile, amp, phase, freq).encode()
+
+    def _sendBatch(self, commands):
+        ack = b'*IDN?\n'
+        chunk = b''
+        for command in commands:
+            if chunk and len(chunk) + len(command) + len(ack) > self.rxBufferSize:
+                self._sendAcknowledged(chunk + ack)
+                chunk = b''
+            chunk += command
+        self._sendAcknowledged(chunk + ack)
+
+    def _sendAcknowledged(self, data):
+        """Sends data, which must end with an identity query, and waits for the
+        answer. The firmware handles commands in order, so once it answers it
+        has processed everything before the query"""
+        self.ser.write(data)
+        self.ser.readline()
+
+    def get_profile(self, profile):
+        return DdsBase.get_profile(self, 0, profile)
 
     def reset(self):
         self.send("reset\n")
+        self.shadow.invalidate()
         
     def identity(self):
         self.send("*IDN?\n")
@@ -82,11 +134,29 @@ class ArduinoDdsSim:
     def __init__(self):
         pass
     
-    def setProfile(self, profile, freq, phase=0.0, amp=1.0):
-        pass
+    def setProfile(self, profile, freq, phase=0.0, amp=1.0, force=False):
+        return True
     
-    def setProfileLSB(self, profile, freq, phase, amp): # Freq, phase, amp are all in units of lsb
-        pass
+    def setProfileLSB(self, profile, freq, phase, amp, force=False): # Freq, phase, amp are all in units of lsb
+        return True
+
+    def setProfiles(self, entries, force=False):
+        return len(entries)
+
+    def setProfilesLSB(self, entries, force=False):
+        return len(entries)
+
+    def get_profile(self, profile):
+        return None
+
+    def get_lsb_freq(self):
+        return 1e9 / 2**32
+
+    def convertToWords(self, freq, phase=0.0, amp=1.0):
+        return DdsConversion(1e9).toWords(freq, phase, amp)
+
+    def get_shadow_stats(self):
+        return {"hits": 0, "misses": 0}
 
     def reset(self):
         pass
@@ -1,46 +1,26 @@
 from artiq.language.core import *
 from artiq.language.units import *
 
+from artiqDrivers.profileSwitcher.profileSwitcher import ProfileSwitcher as _ProfileSwitcher
+from artiqDrivers.profileSwitcher.profileSwitcher import InvalidProfile
 
-class ProfileSwitcher:
-    def __init__(self, dmgr, device, profile_lines, interProfileDelay=200*ns, finalDelay=200*ns):
+
+class ProfileSwitcher(_ProfileSwitcher):
+    def __init__(self, dmgr, device, profile_lines, interProfileDelay=200*ns, finalDelay=200*ns,
+                 sameFrequency=(), timestamped=False, skew_mu=None):
         """interProfileDelay is the delay to insert between switching profile lines.
         finalDelay is the delay to add after all profile changes have occured.
-        Profile line order is [p0, p1, p2]"""
-        self.core = dmgr.get("core")
+        Profile line order is [p0, p1, p2]
+        sameFrequency is an optional list of groups of profiles which share a
+        frequency, used to order the line changes.
+        timestamped and skew_mu select switching all lines at one RTIO timestamp,
+        see artiqDrivers.profileSwitcher.profileSwitcher.ProfileSwitcher"""
+        _ProfileSwitcher.__init__(self, dmgr, profile_lines[:3],
+                                  interProfileDelay=interProfileDelay,
+                                  finalDelay=finalDelay, sameFrequency=sameFrequency,
+                                  timestamped=timestamped, skew_mu=skew_mu)
         self.device = dmgr.get(device)
-        
-        self.p0 = dmgr.get(profile_lines[0])
-        self.p1 = dmgr.get(profile_lines[1])
-        self.p2 = dmgr.get(profile_lines[2])
-        
-        self.interProfileDelay_mu = seconds_to_mu(interProfileDelay, self.core)
-        self.finalDelay_mu = seconds_to_mu(finalDelay, self.core)
-
-        
-    @kernel
-    def setProfile(self, profile):
-        if profile < 0 or profile > 7:
-            raise InvalidProfile()
-        
-        if profile & 0x4:
-            self.p2.on()
-        else:
-            self.p2.off()
-        delay(200*ns)#self.interProfileDelay_mu)      
-      
-        if profile & 0x2:
-            self.p1.on()
-        else:
-            self.p1.off()
-        delay(200*ns)#self.interProfileDelay_mu)
-        
-        if profile & 0x1:
-            self.p0.on()
-        else:
-            self.p0.off()
-        delay(200*ns)#self.finalDelay_mu)        
-        
 
-class InvalidProfile(Exception):
-    pass
+        self.p0 = self.profiles[0]
+        self.p1 = self.profiles[1]
+        self.p2 = self.profiles[2]
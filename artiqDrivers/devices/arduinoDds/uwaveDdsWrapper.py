@@ -1,22 +1,91 @@
 from artiq.language.core import *
+import numpy as np
+
+from artiqDrivers.devices.dds_conversion import DdsConversion
 
 
 class UwaveDdsWrapper:
     """Wraps an Arduino DDS class to allow profiles to be set in logical frequencies (detunings from zero field) rather than the physical frequencies that are the input to the mixup chain
-    !!! The profiles are switched sequentially by profile select line with 200ns delay. When switching profiles care has to be taken that the intermediate profiles that are enabled for a short time during the switching process have the same frequency as the previously selected one, otherwise the phase will become scrambled!!! """
-    def __init__(self, dmgr, device, LOfrequency):
+    !!! The profiles are switched sequentially by profile select line with 200ns delay. When switching profiles care has to be taken that the intermediate profiles that are enabled for a short time during the switching process have the same frequency as the previously selected one, otherwise the phase will become scrambled!!!
+    (Unless the ProfileSwitcher is in timestamped mode, which changes all profile select lines at the same RTIO timestamp.)
+
+    The mixing chain mixes the DDS output with the LO and keeps one sideband,
+    so the microwave frequency is LOfrequency + sideband*DDS frequency, where
+    sideband is +1 (upper) or -1 (lower). Logical frequencies are offsets from
+    zeroFieldFrequency."""
+    zeroFieldFrequency = 3225.6082864e6 # S1/2 F=4 - F=3 splitting at zero field, Hz
+
+    def __init__(self, dmgr, device, LOfrequency, sideband=+1, zeroFieldFrequency=None):
         self.core = dmgr.get("core")
 
         self.dds = dmgr.get(device)
 
-        zeroFieldFrequency = 3225.6082864e6 # S1/2 F=4 - F=3 splitting at zero field, Hz
-        
+        if sideband not in (+1, -1):
+            raise ValueError("sideband must be +1 or -1")
+        self.LOfrequency = LOfrequency
+        self.sideband = sideband
+        if zeroFieldFrequency is not None:
+            self.zeroFieldFrequency = zeroFieldFrequency
+
         # To get the DDS frequency, subtract off target frequency from this offset frequency
-        self.offsetFrequency = - LOfrequency + zeroFieldFrequency
-    
+        self.offsetFrequency = - LOfrequency + self.zeroFieldFrequency
+
+        # DdsConversion for the DDS, created on first use
+        self._conversion = None
+
+    def _get_conversion(self):
+        if self._conversion is None:
+            self._conversion = DdsConversion.fromLsbFreq(self.dds.get_lsb_freq())
+        return self._conversion
+
+    def plan(self, freqs, phases=0.0, amps=1.0):
+        """Computes the DDS words for logical frequencies 'freqs' (Hz, scalar
+        or array), phases (degrees) and amplitudes (full-scale), broadcast
+        against each other, for the mixing chain. Every point is validated
+        before anything is returned.
+        Returns (freq words, phase words, amp words, actual logical frequencies
+        after LSB rounding)"""
+        freqs, phases, amps = np.broadcast_arrays(
+            np.asarray(freqs, dtype=float), phases, amps)
+        freqDDS = self.sideband*(self.offsetFrequency + freqs)
+        if np.any(freqDDS < 0):
+            bad = freqs[freqDDS < 0].flat[0]
+            raise ValueError("Frequency {:.0f}Hz is on the wrong side of the LO for this sideband".format(bad))
+        conversion = self._get_conversion()
+        freqWords, phaseWords, ampWords = conversion.toWords(
+            freqDDS, self.sideband*phases, amps)
+        actual = self.sideband*freqWords*conversion.lsbFreq - self.offsetFrequency
+        return freqWords, phaseWords, ampWords, actual
+
+    def setProfiles(self, profiles, freqs, phases=0.0, amps=1.0):
+        """Sets the DDS profiles to logical frequencies 'freqs' (with phases and
+        amplitudes broadcast against them) through the mixing chain, with all
+        profiles written as a single batch. profiles must hold one distinct
+        profile per frequency, or be a scalar if freqs is; this is checked
+        before anything is sent.
+        Returns the actual logical frequencies after LSB rounding, as a scalar
+        if only scalars were given"""
+        freqWords, phaseWords, ampWords, actual = self.plan(freqs, phases, amps)
+        # plan returns ints rather than arrays for scalar input
+        freqWords, phaseWords, ampWords = (np.atleast_1d(w) for w in
+                                           (freqWords, phaseWords, ampWords))
+        profiles = np.atleast_1d(profiles)
+        if profiles.shape != freqWords.shape:
+            raise ValueError("Need one profile per frequency, got {} profiles for {} frequencies".format(
+                profiles.size, freqWords.size))
+        if not np.all((profiles >= 0) & (profiles <= 7)):
+            raise ValueError("DDS profile should be between 0 and 7")
+        if len(np.unique(profiles)) != profiles.size:
+            raise ValueError("Each profile can only be set to one frequency")
+        self.dds.setProfilesLSB([(int(p), int(f), int(ph), int(a)) for (p, f, ph, a)
+                                 in zip(profiles.flat, freqWords.flat,
+                                        phaseWords.flat, ampWords.flat)])
+        return actual
 
     def setProfile(self, profile, freq, phase=0.0, amp=1.0):
+        """Sets a profile to the physical DDS frequency 'freq', without the
+        mixing chain (see setProfiles for logical frequencies)"""
         #freqDDS = self.offsetFrequency + freq
         freqDDS = freq
-        
+
         self.dds.setProfile(profile, freqDDS, phase, amp)
@@ -1,26 +1,76 @@
 import logging
+import hashlib
 import serial
-import math
+import struct
 import time
+import numpy as np
+from contextlib import contextmanager
+
+from artiqDrivers.devices.coherentDds import pulse_shapes
+from artiqDrivers.devices.coherentDds.simulator import SimulatedFirmware
+from artiqDrivers.devices.dds_base import DdsBase
 
 
 logger = logging.getLogger(__name__)
 
 
-class CoherentDds:
+# Binary wire protocol. Firmware which advertises BINARY_PROTOCOL_TAG in its
+# identity string accepts, in addition to the ASCII commands, frames of the form
+#   sync byte (0xb5), opcode (u8), payload length in bytes (u16), payload,
+#   checksum (u8)
+# where all multi-byte fields are little-endian and the checksum is chosen so
+# that the opcode, length, payload and checksum bytes sum to 0 modulo 256.
+# Queries (idn?, getSpiWord? etc.) always use the ASCII protocol.
+BINARY_PROTOCOL_TAG = "binproto"
+FRAME_SYNC = 0xb5
+OP_SET_PROFILE = 0x01 # payload: channel (u8), profile (u8), freq (u32), phase (u16), amp (u16)
+OP_RESET_PHASE = 0x02 # no payload
+OP_SET_PULSE_SHAPE = 0x03 # payload: shape channel (u8), n x amplitude (u16)
+
+# Firmware which advertises SYNC_TAG in its identity string answers
+# 'sync <token>\n' with '<token>\n' once all earlier commands have been
+# processed. Otherwise the full identity string is used as the acknowledgement.
+SYNC_TAG = "sync"
+
+
+def _frame(opcode, payload=b''):
+    """Wraps a payload in a binary protocol frame"""
+    header = struct.pack('<BH', opcode, len(payload))
+    checksum = -(sum(header) + sum(payload)) & 0xff
+    return bytes([FRAME_SYNC]) + header + payload + bytes([checksum])
+
+
+class CoherentDds(DdsBase):
     ser = None;
-    lsbAmp = 1.0 / 16383 # 0x3fff is maximum amplitude
-    lsbPhase = 360.0 / 65536 # Degrees per LSB.
+    nChannels = 4
+    # Profiles used to hold scan table points. Profile 7 is left free, as
+    # DdsGroup reserves it as an 'off' profile
+    scanProfiles = list(range(7))
 
     def __init__(self, addr, clockFreq, baudrate=115200, internal_clock=False,
-                 incoherent_channels=[False, False, False, False]):
+                 incoherent_channels=[False, False, False, False], binary=True):
         # addr : serial port name
         # clockFreq : clock frequency in Hz
         # internal_clock: if true, use internal 1 GHz clock
         # incoherent_channels: array listing which channels coherence is disabled
-        self.ser = serial.Serial(addr, baudrate=baudrate)
-        self.lsbFreq = clockFreq / (2**32);
-        self.clockFreq = clockFreq
+        # binary: use the binary protocol if the firmware supports it
+        self.addr = addr
+        self.baudrate = baudrate
+        DdsBase.__init__(self, clockFreq)
+        self.ser = self._openSerial()
+
+        # Hash of the quantised pulse shape each shape channel holds, or None if
+        # unknown
+        self._invalidatePulseShapes()
+        # Scan tables, as (freq, phase, amp) word arrays, for each channel
+        self._scanTables = [None]*4
+
+        self.useBinary = binary
+        self.binary = False
+        self.syncSupported = False
+        # Token of the last sync, increasing monotonically
+        self._syncToken = 0
+        self._negotiateProtocol()
 
         self.disableCoherenceMode(*incoherent_channels)
 
@@ -38,124 +88,333 @@ class CoherentDds:
         line = self.ser.readline().decode().strip()
         return int(line, 16)
 
-    def get_lsb_freq(self):
-        return self.lsbFreq
-
     def send(self, data):
-        self.ser.write(data.encode())
+        if isinstance(data, str):
+            data = data.encode()
+        self.ser.write(data)
+
+    def reconnect(self):
+        """Close and reopen the serial port. The device state is assumed to be
+        unknown afterwards"""
+        self.ser.close()
+        self.ser = self._openSerial()
+        self._invalidatePulseShapes()
+        self.shadow.invalidate()
+        self.binary = False
+        self.syncSupported = False
+        self._negotiateProtocol()
+
+    def _openSerial(self):
+        return serial.Serial(self.addr, baudrate=self.baudrate)
+
+    def _invalidatePulseShapes(self):
+        self._pulseShapeHashes = [None]*4
+
+    def _negotiateProtocol(self):
+        """Switch to the binary protocol and sync command if the firmware
+        advertises them"""
+        idn = self.identity()
+        tags = idn.replace(',', ' ').split()
+        self.binary = self.useBinary and BINARY_PROTOCOL_TAG in tags
+        self.syncSupported = SYNC_TAG in tags
+        logger.info("Connected to CoherentDds '{}', using {} protocol".format(
+            idn, "binary" if self.binary else "ASCII"))
 
     def identity(self):
         """Returns a string representing the firmware name and version"""
         self.send('idn?\n')
         return self.ser.readline().decode().strip()
 
+    def sync(self):
+        """Waits until the device has processed all commands sent so far.
+        Returns the sync token, which increases by one on every sync"""
+        command, token = self._syncCommand()
+        self.send(command)
+        self._readSync(token)
+        return token
+
+    def _syncCommand(self):
+        """Returns the command for the next sync, and its token"""
+        self._syncToken += 1
+        if self.syncSupported:
+            return 'sync {}\n'.format(self._syncToken).encode(), self._syncToken
+        return b'idn?\n', self._syncToken
+
+    def _readSync(self, token):
+        line = self.ser.readline().decode().strip()
+        if self.syncSupported and line != str(token):
+            # Drop the cached state, as we no longer know what the device holds
+            self.shadow.invalidate()
+            self._invalidatePulseShapes()
+            raise IOError("CoherentDds sync mismatch, expected '{}' but got '{}'".format(
+                token, line))
+
     def resetPhase(self):
-        self.send('resetPhase\n');
+        self.send(self.resetPhaseCommand())
 
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0):
+    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, force=False):
         """Sets a DDS profile frequency (Hz), phase (degrees), and amplitude (full-scale).
-        phase defaults to 0 and amplitude defaults to 1"""
-        if amp < 0 or amp > 1:
-            raise ValueError("DDS amplitude must be between 0 and 1")
-        if freq < 0 or freq > 450e6: # This should be dependant on the clock frequency
-            raise ValueError("DDS frequency must be between 0 and 450 MHz")
-
-        ampWord = int(round( amp * 0x3fff ))
-        phaseWord = int(round( (phase % 360) / 360.0 * 0xffff ))
-        freqWord = int(round( freq / self.lsbFreq ))
-        self.setProfileWords(channel, profile, freqWord, phaseWord, ampWord)
-
-    def setProfileWords(self, channel, profile, freq, phase, amp): # Freq, phase, amp are all in units of lsb
+        phase defaults to 0 and amplitude defaults to 1.
+        The write is skipped if the profile already holds the same words, unless
+        force is True. Returns True if the profile was written"""
+        freqWord, phaseWord, ampWord = self._profileToWords(freq, phase, amp)
+        return self.setProfileWords(channel, profile, freqWord, phaseWord, ampWord,
+                                    force=force)
+
+    def setProfileWords(self, channel, profile, freq, phase, amp, force=False): # Freq, phase, amp are all in units of lsb
         profile = int(profile) # have to do this, because artiq uses a special artiq.integer
+        self._checkProfileWords(channel, profile, freq, phase, amp)
+        words = (freq, phase, amp)
+        if not (force or self.shadow.isDirty(channel, profile, words)):
+            return False
+        self.send(self._profileCommand(channel, profile, freq, phase, amp))
+        self.shadow.update(channel, profile, words)
+        return True
+
+    def setProfiles(self, entries, resetPhase=False, force=False):
+        """Sets several DDS profiles with a single serial write and a single
+        acknowledgement. entries is a list of (channel, profile, freq, phase, amp)
+        tuples, with freq in Hz, phase in degrees and amp in full-scale.
+        The whole table is validated before anything is sent, and profiles which
+        already hold the requested words are skipped unless force is True.
+        If resetPhase is True the phase is reset once after the profiles have
+        been written, provided at least one of them changed.
+        Returns the number of profiles written"""
+        words = []
+        for (channel, profile, freq, phase, amp) in entries:
+            words.append((channel, profile) + self._profileToWords(freq, phase, amp))
+        return self.setProfilesWords(words, resetPhase=resetPhase, force=force)
+
+    def setProfilesWords(self, entries, resetPhase=False, force=False):
+        """As setProfiles, but entries are (channel, profile, freq, phase, amp)
+        tuples with freq, phase and amp in units of lsb"""
+        extraCommands = [self.resetPhaseCommand()] if resetPhase else []
+        return self._writeProfiles(entries, force=force, extraCommands=extraCommands)
+
+    def _sendBatch(self, commands):
+        # A sync acts as the acknowledgement for the whole batch, as the
+        # firmware processes commands in order
+        syncCommand, token = self._syncCommand()
+        self.send(b''.join(commands) + syncCommand)
+        self._readSync(token)
+
+    def loadScanTable(self, channel, freqs, phases=0.0, amps=1.0):
+        """Converts and validates a whole scan for a channel in one call, and
+        loads its first page into the scan profiles (see scanProfiles) with a
+        single serial write.
+
+        The firmware can only step between its 8 hardware profiles, so the
+        scan is played as pages of len(scanProfiles) points: point i lives in
+        profile scanProfiles[i % pageSize] once page i // pageSize has been
+        loaded with loadScanPage. Points are selected in real time with the
+        profile pins or SPI. Returns the number of points in the scan"""
         if channel < 0 or channel > 3 or not isinstance(channel, int):
             raise ValueError("DDS channel should be an integer between 0 and 3")
-        if profile < 0 or profile > 7 or not isinstance(profile, int):
-            raise ValueError("DDS profile should be an integer between 0 and 7")
-        if amp > 0x3fff or amp < 0 or not isinstance(amp, int):
-            raise ValueError("DDS amplitude word should be an integer between 0 and 0x3fff")
-        if phase > 0xffff or phase < 0 or not isinstance(phase, int):
-            raise ValueError("DDS phase word should be an integer between 0 and 0xffff")
-        if freq < 0 or freq > 0xffffffff or not isinstance(freq, int):
-            raise ValueError("DDS frequency word should be an integer between 0 and 0xffffffff")
-
-        self.send('setProfile {} {} {} {} {}\n'.format( channel, profile, freq, phase, amp) );
+        freqs = np.atleast_1d(freqs)
+        words = self.conversion.toWords(freqs, phases, amps)
+        self._scanTables[channel] = np.stack(words, axis=1)
+        self.loadScanPage(channel, 0)
+        return len(self._scanTables[channel])
+
+    def loadScanPage(self, channel, page):
+        """Loads page 'page' of the channel's scan table into the scan profiles.
+        Returns the number of points in the page"""
+        table = self._scanTables[channel]
+        if table is None:
+            raise ValueError("No scan table loaded for channel {}".format(channel))
+        pageSize = len(self.scanProfiles)
+        points = table[page*pageSize:(page+1)*pageSize]
+        if not len(points):
+            raise ValueError("Scan page {} out of range".format(page))
+        self.setProfilesWords([(channel, profile) + tuple(int(w) for w in words)
+                               for profile, words in zip(self.scanProfiles, points)])
+        return len(points)
+
+    def getScanPageSize(self):
+        return len(self.scanProfiles)
+
+    def _profileCommand(self, channel, profile, freq, phase, amp):
+        if self.binary:
+            return _frame(OP_SET_PROFILE,
+                          struct.pack('<BBIHH', channel, profile, freq, phase, amp))
+        return 'setProfile {} {} {} {} {}\n'.format(
+            channel, profile, freq, phase, amp).encode()
+
+    def resetPhaseCommand(self):
+        """Returns the command which resets the phase, without sending it"""
+        if self.binary:
+            return _frame(OP_RESET_PHASE)
+        return b'resetPhase\n'
+
+    def _pulseShapeCommand(self, shapeChannel, quantisedShapeVec):
+        if self.binary:
+            payload = bytes([shapeChannel]) + quantisedShapeVec.astype('<u2').tobytes()
+            return _frame(OP_SET_PULSE_SHAPE, payload)
+        return 'setPulseShape {}\n{}\n'.format(shapeChannel,
+            ','.join(map(str, quantisedShapeVec.tolist()))).encode()
 
     def reset(self):
         self.send('reset\n');
         time.sleep(50e-3);
+        self._invalidatePulseShapes()
+        self.shadow.invalidate()
 
     def disableCoherenceMode(self, ch0=False, ch1=False, ch2=False, ch3=False):
         self.send('setDisableCoherence {:d} {:d} {:d} {:d}\n'.\
                 format(ch0,ch1,ch2,ch3))
         self.ser.readline()
 
-    def setPulseShape(self, shapeChannel, shapeVec):
+    def setPulseShape(self, shapeChannel, shapeVec, force=False):
+        """Sets the pulse shape of shapeChannel. shapeVec is a list or array of
+        between 1 and 2048 amplitudes in full-scale units.
+        The upload is skipped if the channel already holds the same quantised
+        shape, unless force is True. Returns True if the shape was uploaded"""
         if shapeChannel < 0 or shapeChannel > 3 or not isinstance(shapeChannel, int):
             raise ValueError("DDS pulse shape channel should be an integer between 0 and 3")
+        quantisedShapeVec = self.quantisePulseShape(shapeVec)
+
+        shapeHash = hashlib.sha1(quantisedShapeVec.tobytes()).digest()
+        if not force and self._pulseShapeHashes[shapeChannel] == shapeHash:
+            return False
+        # Forget the old shape first, so that a failed write leaves the cache
+        # invalid rather than wrong
+        self._pulseShapeHashes[shapeChannel] = None
+        self.send(self._pulseShapeCommand(shapeChannel, quantisedShapeVec))
+        self._pulseShapeHashes[shapeChannel] = shapeHash
+        return True
+
+    @staticmethod
+    def quantisePulseShape(shapeVec):
+        """Returns shapeVec quantised to amplitude words as a uint16 array"""
+        shapeVec = np.asarray(shapeVec, dtype=float).ravel()
         if len(shapeVec) < 1 or len(shapeVec) > 2048:
             raise ValueError("DDS pulse shape array length should be between 1 and 2048")
-
-        quantisedShapeVec = []
-        for el in shapeVec:
-            quantisedEl = round(el*0x3fff)
-            if quantisedEl < 0 or quantisedEl > 0x3fff:
-                raise ValueError("DDS pulse shape points should all be between 0.0 and 1.0")
-            quantisedShapeVec.append(quantisedEl)
-
-        self.send('setPulseShape {}\n'.format(shapeChannel))
-        for i in range(len(quantisedShapeVec)):
-            self.send('%d' % quantisedShapeVec[i]);
-            if i != len(quantisedShapeVec)-1:
-                self.send(',');
-        self.send('\n');
+        quantisedShapeVec = np.round(shapeVec*0x3fff)
+        if not np.all((quantisedShapeVec >= 0) & (quantisedShapeVec <= 0x3fff)):
+            raise ValueError("DDS pulse shape points should all be between 0.0 and 1.0")
+        return quantisedShapeVec.astype(np.uint16)
 
     def setSensiblePulseShape(self, duration, shapeChannel=0):
         """Sets a sensible looking pulse shape with total duration 'duration' seconds. The duration must be between 0 and 10us"""
+        return self.setStandardPulseShape(duration, "sensible", shapeChannel=shapeChannel)
+
+    def setStandardPulseShape(self, duration, shape, shapeChannel=0, force=False,
+                              **kwargs):
+        """Sets one of the standard pulse shapes in pulse_shapes.shapes ('sensible',
+        'blackman', 'cos2', 'gaussian', 'erf') with total duration 'duration'
+        seconds. Extra keyword arguments (e.g. sigma) are passed to the shape
+        function. The duration must be between 0.2us and 10us"""
         if duration > 10e-6 or duration < 0.2e-6:
             raise ValueError("DDS pulse shape duration must be between 0.2us and 10us")
+        if shape not in pulse_shapes.shapes:
+            raise ValueError("Unknown pulse shape '{}', should be one of {}".format(
+                shape, sorted(pulse_shapes.shapes)))
 
-        shapeVec = []
-        i_max = round(duration*250e6/2) # /2 because clock used is divided by 2, 250MHz is DDS sync clk
-        for i in range(i_max):
-            y = 0.209*math.log10( (math.sin((1+i)/float(i_max+1)*math.pi/2))**4 ) + 1
-            if y < 0:
-                y = 0
-            shapeVec.append(y)
-        self.setPulseShape(shapeChannel, shapeVec)
+        n = pulse_shapes.samples_for_duration(duration)
+        return self.setPulseShape(shapeChannel, pulse_shapes.shapes[shape](n, **kwargs),
+                                  force=force)
 
     def setClockSource(self, clock_internal=False):
         """Choose between external clock (default) and internal 1 GHz source"""
         self.send('setClockSource {:d}\n'.format(clock_internal))
         self.ser.readline()
         self.ser.readline()
+        self._invalidatePulseShapes()
 
     def ping(self):
         return True
 
 
-class CoherentDdsSim:
-    def __init__(self):
-        pass
-
-    def identity(self):
-        return "coherentdds simulation"
-
-    def resetPhase(self):
-        logger.warning("Resetting phase")
-        pass
-
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0):
-        logger.warning("Setting ch:p {}:{} to freq={}, phase={}, amp={}".format(channel,profile,freq,phase,amp))
-        pass
-
-    def setProfileWords(self, channel, profile, freq, phase, amp): # Freq, phase, amp are all in units of lsb
-        pass
+class CoherentDdsSim(CoherentDds):
+    """CoherentDds talking to a model of the firmware (see simulator.py) instead
+    of a serial port. All of the driver logic runs unchanged, so the serial
+    traffic generated by the wrappers can be inspected and timed without
+    hardware: the model records a trace of every command, and the bytes, round
+    trips and simulated serial time of each named operation can be measured
+    with begin_operation()/end_operation() (or measure() on the host)"""
+    def __init__(self, clockFreq=1e9, baudrate=115200, internal_clock=False,
+                 incoherent_channels=[False, False, False, False], binary=True,
+                 sync=True, latency=1e-3):
+        # binary, sync: whether the simulated firmware supports the binary
+        #   protocol and the sync command
+        # latency: simulated turnaround time of each query, in seconds
+        self._firmwareArgs = {"binary": binary, "sync": sync, "latency": latency}
+        self._operation = None
+        self._operationStats = {}
+        CoherentDds.__init__(self, "simulation", clockFreq, baudrate=baudrate,
+                             internal_clock=internal_clock,
+                             incoherent_channels=incoherent_channels)
+
+    def _openSerial(self):
+        # The simulated device keeps its state across reconnects, as the real
+        # one does
+        if self.ser is None:
+            return SimulatedFirmware(self.clockFreq, baudrate=self.baudrate,
+                                     **self._firmwareArgs)
+        return self.ser
 
     def reset(self):
-        pass
-
-    def setPulseShape(self, shapeChannel, shapeVec):
-        pass
-
-    def ping(self):
-        return True
+        self.send('reset\n')
+        self._invalidatePulseShapes()
+        self.shadow.invalidate()
+
+    def _counters(self):
+        return {"bytes_written": self.ser.bytesWritten,
+                "bytes_read": self.ser.bytesRead,
+                "round_trips": self.ser.roundTrips,
+                "commands": self.ser.commands,
+                "duration": self.ser.time}
+
+    def begin_operation(self, name):
+        """Starts measuring the serial traffic of an operation called 'name'"""
+        self._operation = (name, self._counters())
+
+    def end_operation(self):
+        """Stops measuring the current operation, adds it to the per-operation
+        totals and returns its bytes written and read, round trips, commands
+        and simulated serial time (seconds)"""
+        name, start = self._operation
+        self._operation = None
+        stats = {k: v - start[k] for k, v in self._counters().items()}
+        totals = self._operationStats.setdefault(
+            name, dict({k: 0 for k in stats}, count=0))
+        for k, v in stats.items():
+            totals[k] += v
+        totals["count"] += 1
+        return stats
+
+    @contextmanager
+    def measure(self, name):
+        self.begin_operation(name)
+        try:
+            yield
+        finally:
+            self.end_operation()
+
+    def get_operation_stats(self):
+        """Returns the totals of each operation measured so far, keyed by name"""
+        return {name: dict(totals) for name, totals in self._operationStats.items()}
+
+    def get_sim_stats(self):
+        """Returns the totals since the simulated device was opened"""
+        return self._counters()
+
+    def get_trace(self, start=0):
+        """Returns the command trace from entry 'start' on, as (simulated time,
+        command, arguments) tuples"""
+        return self.ser.trace[start:]
+
+    def clear_trace(self):
+        self.ser.trace = []
+        self._operationStats = {}
+
+    def get_sim_profile(self, channel, profile):
+        """Returns the (freq, phase, amp) words the simulated device holds"""
+        return tuple(int(w) for w in self.ser.profiles[channel, profile])
+
+    def get_sim_pulse_shape(self, shapeChannel):
+        return self.ser.pulseShapes[shapeChannel].tolist()
+
+    def get_sim_phase(self, channel, profile):
+        """Returns the output phase (turns) of a channel on a profile now"""
+        return float(self.ser.phase(channel, profile))
@@ -2,6 +2,40 @@ from artiq.language.core import *
 from artiq.language import us
 import numpy as np
 from artiq.coredevice import spi2
+from collections import OrderedDict
+from contextlib import contextmanager
+from artiqDrivers.devices.dds_conversion import DdsConversion
+
+
+# SPI wire format:
+# cs low, clock in 8 bit word, cs high
+# bits 7-6 : mode, 0=set profile select, 1=set pulse enable, 2=reset phase,
+#            3=broadcast
+# bits 5-4 : channel, 0-3 for DDS channel 0-3 (if mode=3 : the broadcast
+#            command, 0=pulse disable, 1=pulse enable)
+# bits 3-0 : mode dependant data
+# if mode=0 : data[2:0] is the profile select vector
+# if mode=1 : data[0] is the pulse enable line
+# if mode=2 : the phase of all channels is reset
+# if mode=3 : data[3:0] is the mask of channels the command applies to
+# The DDS control signals take effect on the rising edge of cs.
+# The broadcast mode needs firmware support, see DdsGroup.
+MODE_PROFILE_SELECT = 0
+MODE_PULSE_ENABLE = 1
+MODE_RESET_PHASE = 2
+MODE_BROADCAST = 3
+
+
+def spi_word(mode, ch, data, invert=False):
+    """Returns the 32 bit word to pass to spi.write for an 8 bit command,
+    inverted if the bus is inverted, as a signed integer for the kernel"""
+    word = (((mode & 3) << 6) | ((ch & 3) << 4) | (data & 0xf)) << 24
+    if invert:
+        word ^= 0xffffffff
+    if word & 0x80000000:
+        word -= 1 << 32
+    return word
+
 
 class DdsGroup:
     """
@@ -21,19 +55,76 @@ class DdsGroup:
     We assume that the startup experiment has setup the SPI buses by calling
     set_xfer(1,8,0) and that the SPI clock_div is set to match the value in this
     class.
+
+    Serial phase resets requested by DdsChannel.set inside a
+    deferred_phase_reset() block are coalesced into a single resetPhase per
+    physical DDS, issued when the block exits.
+
+    By default the SPI configuration is written before every transfer, as
+    other drivers may share the buses. If 'exclusive_spi' is True the group
+    assumes that nothing else reconfigures its buses, and only writes the
+    configuration the first time each bus is used (see _spi_set_config),
+    saving an RTIO event per profile switch, pulse enable and phase reset.
+    Call invalidate_spi_config() if something else may have reconfigured the
+    buses after all.
+
+    Channels whose DDS has no SPI interface cannot be used from kernels; the
+    kernel methods raise ValueError for them.
+
+    pulse_enable_channels and reset_phase_channels act on several channels at
+    the same timestamp. If 'broadcast' is True the DDS firmware is assumed to
+    support the broadcast SPI command, and the pulse enable of all channels on
+    one board is set by a single transfer; otherwise one transfer per channel
+    is sent back-to-back. A phase reset always acts on the whole board, so only
+    one is sent per bus.
+
+    Instead of choosing profile numbers by hand, DdsChannel.allocate_profile
+    assigns one of profiles 0-6 to each tone, keeping recently used tones
+    resident (see ProfileAllocator).
     """
-    kernel_invariants = {"core", "profile_delay_mu", "padding_mu"}
+    kernel_invariants = {"core", "profile_delay_mu", "padding_mu", "spi_buses",
+                         "invert", "spi_config_flags", "broadcast",
+                         "broadcast_words", "reset_word", "exclusive_spi"}
 
-    def __init__(self, dmgr, devices, mappings, clock_div, invert=False):
+    def __init__(self, dmgr, devices, mappings, clock_div, invert=False,
+                 broadcast=False, exclusive_spi=False):
         self.core = dmgr.get("core")
 
         self.invert = invert
+        self.broadcast = broadcast
+        self.exclusive_spi = exclusive_spi
+        # Broadcast pulse enable words, indexed by enable*16 + channel mask
+        self.broadcast_words = [spi_word(MODE_BROADCAST, enable, mask, invert)
+                                for enable in range(2) for mask in range(16)]
+        self.reset_word = spi_word(MODE_RESET_PHASE, 0, 0, invert)
+        if invert:
+            # flags set: SPI_END sets cs to inactive at end of write, others do the inversion of everything but the signal
+            self.spi_config_flags = spi2.SPI_END|spi2.SPI_CLK_POLARITY|spi2.SPI_CS_POLARITY
+        else:
+            self.spi_config_flags = spi2.SPI_END
 
         dds_devices = {}
         spi_devices = {}
+        # Distinct SPI buses, and the index into spi_buses for each DDS
+        self.spi_buses = []
+        spi_bus_names = []
+        bus_indices = {}
         for (dds_name, spi_name) in devices:
             dds_devices[dds_name] = dmgr.get(dds_name)
             spi_devices[dds_name] = dmgr.get(spi_name) if spi_name else None
+            if spi_name:
+                if spi_name not in spi_bus_names:
+                    spi_bus_names.append(spi_name)
+                    self.spi_buses.append(spi_devices[dds_name])
+                bus_indices[dds_name] = spi_bus_names.index(spi_name)
+            else:
+                bus_indices[dds_name] = -1
+        self.dds_devices = dds_devices
+        # Whether each SPI bus has been configured by this group
+        self.spi_configured = [False]*len(self.spi_buses)
+
+        self._defer_depth = 0
+        self._phase_dirty = set()
 
         ref_period_mu = self.core.seconds_to_mu(self.core.coarse_ref_period)
         write_period_mu = clock_div*ref_period_mu
@@ -50,40 +141,340 @@ class DdsGroup:
             spi_dev = spi_devices[dev_name]
 
             channel_cls = DdsChannel(self.core, dds_dev, spi_dev, ch,\
-                                    self._spi_write)
+                                    self._spi_write, dev_name,
+                                    self.request_phase_reset,
+                                    bus_indices[dev_name], invert)
             setattr(self, channel, channel_cls)
 
-    @kernel
-    def _spi_write(self, spi, data, delay):
-        if self.invert:
-            spi.set_config_mu((spi2.SPI_END|spi2.SPI_CLK_POLARITY|spi2.SPI_CS_POLARITY), 8, 10, 1)
-            # flags set: SPI_END sets cs to inactive at end of write, others do the inversion of everything but the signal
-            # 8: 8bits, write length; 10: speed, division of clock speed by 10, can be anything >2, 1: initial state of cs, ie cs active
-            spi.write(~(data<<24))
+    def request_phase_reset(self, dev_name):
+        """Resets the phase of a physical DDS over the serial link, or marks it
+        as needing a reset if inside a deferred_phase_reset() block"""
+        if self._defer_depth:
+            self._phase_dirty.add(dev_name)
         else:
-            spi.set_config_mu(spi2.SPI_END, 8, 10, 1)
-            spi.write(data<<24)
+            self.dds_devices[dev_name].resetPhase()
+
+    @contextmanager
+    def deferred_phase_reset(self):
+        """Context manager within which serial phase resets are deferred, and
+        then issued once per physical DDS on exit"""
+        self._defer_depth += 1
+        try:
+            yield
+        finally:
+            self._defer_depth -= 1
+            if not self._defer_depth:
+                self.commit_phase_reset()
+
+    def commit_phase_reset(self):
+        """Issues one resetPhase for each physical DDS marked as phase-dirty"""
+        dirty = self._phase_dirty
+        self._phase_dirty = set()
+        for dev_name in sorted(dirty):
+            self.dds_devices[dev_name].resetPhase()
+
+    def serial_reset_phase(self, channels=None):
+        """Resets the phase over the serial link of each physical DDS driving
+        one of the given DdsChannels (all DDSs by default), once per DDS"""
+        if channels is None:
+            dev_names = self.dds_devices.keys()
+        else:
+            dev_names = {channel.dev_name for channel in channels}
+        for dev_name in sorted(dev_names):
+            self.request_phase_reset(dev_name)
+
+    def sync(self, channels=None):
+        """Waits until each physical DDS driving one of the given DdsChannels
+        (all DDSs by default) has processed its serial commands, with one sync
+        per DDS"""
+        if channels is None:
+            dev_names = self.dds_devices.keys()
+        else:
+            dev_names = {channel.dev_name for channel in channels}
+        for dev_name in sorted(dev_names):
+            self.dds_devices[dev_name].sync()
+
+    def set_mu_batch(self, entries):
+        """Writes several profiles, given as (DdsChannel, profile, ftw, asf, pow)
+        tuples, in DDS words. Each physical DDS receives all of its profiles,
+        one phase reset and one acknowledgement in a single RPC. Returns True if
+        any profile changed"""
+        by_dev = {}
+        for (channel, profile, ftw, asf, pow_) in entries:
+            channel.allocator.forget_profile(profile)
+            by_dev.setdefault(channel.dev_name, []).append(
+                (channel.ch, profile, ftw, pow_, asf))
+        changed = False
+        for dev_name in sorted(by_dev):
+            if self.dds_devices[dev_name].setProfilesWords(by_dev[dev_name],
+                                                           resetPhase=True):
+                changed = True
+        return changed
+
+    @kernel
+    def use_profiles(self, channels, profiles, delay=True):
+        """Switch several DdsChannels to the corresponding entries of profiles.
+        All writes start at the current timestamp: each SPI bus is configured
+        once and its channels are written back-to-back, with different buses
+        running in parallel. A single profile switching delay is added at the
+        end, after the last write on any bus."""
+        self._check_spi(channels)
+        t_start = now_mu()
+        t_end = t_start
+        for bus in range(len(self.spi_buses)):
+            at_mu(t_start)
+            configured = False
+            for i in range(len(channels)):
+                if channels[i].bus == bus:
+                    if not configured:
+                        self._spi_set_config(bus)
+                        configured = True
+                    self.spi_buses[bus].write(channels[i].profile_words[profiles[i] & 7])
+            if now_mu() > t_end:
+                t_end = now_mu()
+        at_mu(t_end)
+        if delay:
+            delay_mu(self.padding_mu+self.profile_delay_mu)
+
+    @kernel
+    def pulse_enable_channels(self, channels, enable):
+        """Sets the pulse enable line of several DdsChannels at the same
+        timestamp, with one transfer per bus if broadcast is enabled"""
+        self._check_spi(channels)
+        t_start = now_mu()
+        t_end = t_start
+        for bus in range(len(self.spi_buses)):
+            at_mu(t_start)
+            mask = 0
+            for i in range(len(channels)):
+                if channels[i].bus == bus:
+                    if mask == 0:
+                        self._spi_set_config(bus)
+                    if not self.broadcast:
+                        self.spi_buses[bus].write(channels[i].enable_words[enable & 1])
+                    mask |= 1 << channels[i].ch
+            if self.broadcast and mask:
+                self.spi_buses[bus].write(self.broadcast_words[(enable & 1)*16 + mask])
+            if now_mu() > t_end:
+                t_end = now_mu()
+        at_mu(t_end)
+
+    @kernel
+    def reset_phase_channels(self, channels):
+        """Resets the phase of the DDSs driving several DdsChannels at the same
+        timestamp, with one transfer per bus"""
+        self._check_spi(channels)
+        t_start = now_mu()
+        t_end = t_start
+        for bus in range(len(self.spi_buses)):
+            at_mu(t_start)
+            for i in range(len(channels)):
+                if channels[i].bus == bus:
+                    self._spi_set_config(bus)
+                    self.spi_buses[bus].write(self.reset_word)
+                    break
+            if now_mu() > t_end:
+                t_end = now_mu()
+        at_mu(t_end)
+        delay_mu(self.padding_mu+self.profile_delay_mu)
+
+    @kernel
+    def _spi_write(self, bus, word, delay):
+        """Writes a precomputed command word (see spi_word) to an SPI bus"""
+        if bus < 0:
+            raise ValueError("DdsChannel has no SPI bus")
+        self._spi_set_config(bus)
+        self.spi_buses[bus].write(word)
         if delay:
             delay_mu(self.padding_mu+self.profile_delay_mu)
 
+    @kernel
+    def _check_spi(self, channels):
+        for i in range(len(channels)):
+            if channels[i].bus < 0:
+                raise ValueError("DdsChannel has no SPI bus")
+
+    @kernel
+    def invalidate_spi_config(self):
+        """Forget which SPI buses have been configured, so that the next write
+        to each bus configures it again"""
+        for bus in range(len(self.spi_configured)):
+            self.spi_configured[bus] = False
+
+    @kernel
+    def _spi_set_config(self, bus):
+        """Configures an SPI bus. With exclusive_spi this is skipped if the bus
+        has already been configured since the last invalidate_spi_config()"""
+        if self.exclusive_spi and self.spi_configured[bus]:
+            return
+        self.spi_configured[bus] = True
+        # 8: 8bits, write length; 10: speed, division of clock speed by 10, can be anything >2, 1: initial state of cs, ie cs active
+        self.spi_buses[bus].set_config_mu(self.spi_config_flags, 8, 10, 1)
+
+
+class ProfileAllocator:
+    """
+    Maps logical tones to physical DDS profiles, evicting the least recently
+    used tone when all profiles are in use. Tones are identified by their
+    (frequency, phase, amplitude) words, so tones which quantise to the same
+    DDS output share a profile.
+    """
+    def __init__(self, profiles=range(7)):
+        self.profiles = list(profiles)
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget all tones, e.g. when profiles have been written directly"""
+        self._tones = OrderedDict() # tone -> profile, least recently used first
+
+    def forget_profile(self, profile):
+        """Forget the tone held by a profile, if any"""
+        for tone, p in self._tones.items():
+            if p == profile:
+                del self._tones[tone]
+                return
+
+    def allocate(self, tone):
+        """Returns (profile, resident), where resident is True if the tone
+        was already allocated to the profile"""
+        if tone in self._tones:
+            self._tones.move_to_end(tone)
+            return self._tones[tone], True
+        if len(self._tones) < len(self.profiles):
+            used = set(self._tones.values())
+            profile = next(p for p in self.profiles if p not in used)
+        else:
+            _, profile = self._tones.popitem(last=False)
+        self._tones[tone] = profile
+        return profile, False
+
 
 class DdsChannel:
-    kernel_invariants = {"spi", "ch"}
-    def __init__(self, core, device, spi, channel, _spi_write):
+    kernel_invariants = {"spi", "ch", "bus", "_spi_write", "profile_words",
+                         "enable_words", "reset_word"}
+    def __init__(self, core, device, spi, channel, _spi_write, dev_name=None,
+                 request_phase_reset=None, bus=-1, invert=False):
         self.core = core
         self.dev = device
         self.spi = spi
         self.ch = channel
         self._spi_write = _spi_write
+        self.dev_name = dev_name
+        self._request_phase_reset = request_phase_reset
+        self.bus = bus # index into DdsGroup.spi_buses, -1 if no SPI
+
+        # SPI command words, so that kernels only need a table lookup
+        self.profile_words = [spi_word(MODE_PROFILE_SELECT, channel, profile, invert)
+                              for profile in range(8)]
+        self.enable_words = [spi_word(MODE_PULSE_ENABLE, channel, enable, invert)
+                             for enable in range(2)]
+        self.reset_word = spi_word(MODE_RESET_PHASE, 0, 0, invert)
+
+        # Scan table state, see load_scan_table
+        self.scan_length = 0
+        self.scan_page_size = 1
+        self.scan_page = -1
+
+        self.allocator = ProfileAllocator()
+        self._conversion = None
 
     def set(self, frequency, profile=0, amplitude=1, phase=0):
-        self.dev.setProfile(self.ch, profile, \
-                            frequency, amp=amplitude, phase=phase)
+        """Returns True if the profile changed. The phase is only reset if
+        the profile changed, and the reset may be deferred by the group"""
+        self.allocator.forget_profile(profile)
+        return self._set(frequency, profile, amplitude, phase)
 
+    def set_mu(self, ftw, profile=0, asf=0x3fff, pow_=0):
+        """Writes a profile in DDS words, with a single RPC that also resets the
+        phase if the profile changed. Returns True if the profile changed"""
+        self.allocator.forget_profile(profile)
+        return bool(self.dev.setProfilesWords([(self.ch, profile, ftw, pow_, asf)],
+                                              resetPhase=True))
+
+    def to_mu(self, frequency, amplitude=1, phase=0):
+        """Returns the (ftw, asf, pow) DDS words for a tone"""
+        if self._conversion is None:
+            self._conversion = DdsConversion.fromLsbFreq(self.get_lsb_freq())
+        ftw, pow_, asf = self._conversion.toWords(frequency, phase, amplitude)
+        return ftw, asf, pow_
+
+    def allocate_profile(self, frequency, amplitude=1, phase=0):
+        """Returns a profile holding the given tone, for use with use_profile.
+        A tone which is already allocated keeps its profile; otherwise the
+        least recently used allocated profile is overwritten. The profile is
+        always passed to the driver, whose shadow registers skip the write if
+        the DDS still holds the tone, so a device reset cannot leave the
+        allocator out of date"""
+        if self._conversion is None:
+            self._conversion = DdsConversion.fromLsbFreq(self.get_lsb_freq())
+        tone = self._conversion.toWords(frequency, phase, amplitude)
+        profile, _ = self.allocator.allocate(tone)
+        try:
+            self._set(frequency, profile, amplitude, phase)
+        except Exception:
+            self.allocator.forget_profile(profile)
+            raise
+        return profile
+
+    def _set(self, frequency, profile, amplitude, phase):
+        if self.dev.setProfile(self.ch, profile, \
+                               frequency, amp=amplitude, phase=phase):
+            if self._request_phase_reset is None:
+                self.dev.resetPhase()
+            else:
+                self._request_phase_reset(self.dev_name)
+            return True
+        return False
+
+    def get_profile(self, profile):
+        """Returns the (frequency, phase, amplitude) last written to a profile,
+        or None if unknown"""
+        return self.dev.get_profile(self.ch, profile)
+
+    def load_scan_table(self, frequencies, amplitudes=1, phases=0):
+        """Sends a whole scan to the DDS controller in one transfer, checking
+        every point, and loads the first page of points into the profiles.
+        Step through it from a kernel with use_scan_point"""
+        self.scan_length = self.dev.loadScanTable(self.ch, frequencies,
+                                                  phases, amplitudes)
+        self.scan_page_size = self.dev.getScanPageSize()
+        self.scan_page = 0
         self.dev.resetPhase()
+        # The scan table overwrites the allocatable profiles
+        self.allocator.invalidate()
+
+    def _load_scan_page(self, page):
+        self.dev.loadScanPage(self.ch, page)
+        # The page overwrites the allocatable profiles
+        self.allocator.invalidate()
+
+    @kernel
+    def use_scan_point(self, index, delay=True):
+        """Switch to point 'index' of the scan table via SPI.
+        Only every scan_page_size points does this need a (blocking) RPC to load
+        the next page of points into the profiles. The page overwrites the
+        profiles that earlier points play from, so the RPC is only made once
+        the RTIO timeline has caught up with the wall clock, and the timeline
+        is then moved past the end of the RPC"""
+        page = index // self.scan_page_size
+        if page != self.scan_page:
+            # Profile selects already queued must play the old page
+            self.core.wait_until_mu(now_mu())
+            self._load_scan_page(page)
+            self.scan_page = page
+            self.core.break_realtime()
+        self.use_profile(index - page*self.scan_page_size, delay=delay)
 
     def set_sensible_pulse_shape(self, duration):
-        self.dev.setSensiblePulseShape(duration,self.ch)
+        """Returns True if the shape had to be uploaded to the DDS"""
+        return self.dev.setSensiblePulseShape(duration,self.ch)
+
+    def set_pulse_shape(self, duration, shape, **kwargs):
+        """Sets one of the standard pulse shapes ('sensible', 'blackman',
+        'cos2', 'gaussian', 'erf'). Returns True if the shape had to be
+        uploaded to the DDS"""
+        return self.dev.setStandardPulseShape(duration, shape,
+                                              shapeChannel=self.ch, **kwargs)
 
     def get_lsb_freq(self):
         return self.dev.get_lsb_freq()
@@ -92,69 +483,24 @@ class DdsChannel:
         idn = self.dev.identity()
         return idn
 
+    def sync(self):
+        """Waits until the DDS has processed all serial commands"""
+        return self.dev.sync()
+
     def serial_reset_phase(self):
         self.dev.resetPhase()
 
     @kernel
     def use_profile(self, profile,delay = True):
         # write via SPI
-        self._write_profile_select(self.spi, self.ch, profile, delay = delay)
+        self._spi_write(self.bus, self.profile_words[profile & 7], delay)
 
     @kernel
     def pulse_enable(self,enable):
         # write via SPI
-        self._write_pulse_enable(self.spi,self.ch,enable)
+        self._spi_write(self.bus, self.enable_words[enable & 1], False)
 
     @kernel
     def reset_phase(self):
         # write via SPI
-        self._write_reset_phase(self.spi)
-
-    @kernel
-    def _write_profile_select(self, spi, ch, profile,delay = True):
-        """Set the profile select for a given spi device and channel number."""
-        # Wire format:
-        # cs low, clock in 8 bit word, cs high
-        # bits 7-6 : mode, 0=set profile select, 1=set pulse enable
-        # bits 5-4 : channel, 0-3 for DDS channel 0-3
-        # bits 3-0 : mode dependant data
-        # if mode=0 : data[2:0] is the profile select vector
-        # if mode=1 : data[0] is the pulse enable line
-        # The DDS control signals take effect on the rising edge of cs.
-
-        data = 0 << 6
-        data += (ch & 3) << 4
-        data += profile & 7
-        self._spi_write(spi,data,delay = delay)
-
-    @kernel
-    def _write_pulse_enable(self, spi, ch, enable):
-        """Set the profile select for a given spi device and channel number."""
-        # Wire format:
-        # cs low, clock in 8 bit word, cs high
-        # bits 7-6 : mode, 0=set profile select, 1=set pulse enable
-        # bits 5-4 : channel, 0-3 for DDS channel 0-3
-        # bits 3-0 : mode dependant data
-        # if mode=0 : data[2:0] is the profile select vector
-        # if mode=1 : data[0] is the pulse enable line
-        # The DDS control signals take effect on the rising edge of cs.
-
-        data = 1 << 6
-        data += (ch & 3) << 4
-        data += enable & 1
-        self._spi_write(spi,data,delay = False)
-
-    @kernel
-    def _write_reset_phase(self, spi):
-        """Set the profile select for a given spi device and channel number."""
-        # Wire format:
-        # cs low, clock in 8 bit word, cs high
-        # bits 7-6 : mode, 0=set profile select, 1=set pulse enable
-        # bits 5-4 : channel, 0-3 for DDS channel 0-3
-        # bits 3-0 : mode dependant data
-        # if mode=0 : data[2:0] is the profile select vector
-        # if mode=1 : data[0] is the pulse enable line
-        # The DDS control signals take effect on the rising edge of cs.
-
-        data = 2 << 6
-        self._spi_write(spi,data,delay = True)
\ No newline at end of file
+        self._spi_write(self.bus, self.reset_word, True)
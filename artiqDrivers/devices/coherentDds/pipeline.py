@@ -0,0 +1,212 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+logger = logging.getLogger(__name__)
+
+
+class CoherentDdsPipeline:
+    """Wraps a CoherentDds so that profile writes and phase resets are queued
+    and written to the serial port in the background, instead of each RPC
+    waiting for its own write.
+
+    Every queued command is given a sequence number, which the RPC returns.
+    Queued commands are coalesced into as few serial writes as possible.
+    flush() waits until everything queued so far has been written to the
+    serial port, and barrier() additionally waits until the device has
+    consumed it. All other methods are ordered after the commands queued
+    before them.
+
+    If a background write fails, the next flush() (and so barrier() or any
+    other method which waits for the queue) raises an IOError, so callers
+    never believe that commands which were lost have been written.
+
+    All serial port accesses happen on a single worker thread, so the server
+    keeps accepting RPCs (and queueing commands) while queued commands are
+    being written. Driver calls which are not queued (loadScanPage, reset etc.)
+    read and write the profile shadow and the protocol state on that thread,
+    so commands are only queued while no such call is in progress."""
+    def __init__(self, dev):
+        self.dev = dev
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._writer = None
+        # Held while queueing commands and during driver calls, see _call
+        self._lock = None
+
+        self._seq = 0 # last sequence number handed out
+        self._written = 0 # last sequence number written to the serial port
+        self._acked = 0 # last sequence number known to be consumed by the device
+        # (sequence number, exception) of the first failed write not yet
+        # reported by flush(), or None
+        self._error = None
+
+    def _getLock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _enqueue(self, data):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._writeLoop())
+        self._seq += 1
+        self._queue.put_nowait((self._seq, data))
+        return self._seq
+
+    async def _writeLoop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            seq, data = await self._queue.get()
+            chunks = [data]
+            while not self._queue.empty():
+                seq, data = self._queue.get_nowait()
+                chunks.append(data)
+            try:
+                await loop.run_in_executor(self._executor, self.dev.send,
+                                           b''.join(chunks))
+                self._written = seq
+            except Exception as e:
+                logger.exception("Failed to write queued commands up to %d", seq)
+                if self._error is None:
+                    self._error = (seq, e)
+                # The shadow was updated optimistically when queueing
+                self.dev.shadow.invalidate()
+            finally:
+                for _ in chunks:
+                    self._queue.task_done()
+
+    async def _call(self, name, *args, **kwargs):
+        """Runs a driver method on the serial thread, after everything queued
+        so far has been written. Nothing is queued until it returns, as the
+        shadow is updated when commands are queued rather than when they are
+        written"""
+        async with self._getLock():
+            await self.flush()
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self._executor, partial(getattr(self.dev, name), *args, **kwargs))
+
+    async def flush(self):
+        """Waits until all queued commands have been written to the serial
+        port. Returns the last sequence number written. Raises IOError if a
+        write has failed since the last flush"""
+        if self._queue is not None:
+            await self._queue.join()
+        if self._error is not None:
+            (seq, e), self._error = self._error, None
+            raise IOError("Failed to write queued commands up to {}: {}".format(
+                seq, e)) from e
+        return self._written
+
+    async def barrier(self):
+        """Waits until the device has consumed all queued commands. Returns the
+        last sequence number acknowledged"""
+        seq = self._seq
+        await self._call("sync")
+        self._acked = max(self._acked, seq)
+        return self._acked
+
+    def get_sequence_numbers(self):
+        """Returns the last sequence numbers queued, written and acknowledged"""
+        return {"queued": self._seq, "written": self._written,
+                "acked": self._acked}
+
+    async def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, force=False):
+        """Queues a profile write. Returns its sequence number, or None if the
+        profile already holds the requested words"""
+        words = self.dev.convertToWords(freq, phase, amp)
+        return await self.setProfileWords(channel, profile, *words, force=force)
+
+    async def setProfileWords(self, channel, profile, freq, phase, amp, force=False):
+        return await self.setProfilesWords([(channel, profile, freq, phase, amp)],
+                                           force=force)
+
+    async def setProfiles(self, entries, resetPhase=False, force=False):
+        """Queues several profile writes (and optionally a phase reset) as one
+        command, see CoherentDds.setProfiles. Returns its sequence number, or
+        None if no profile needed writing"""
+        words = []
+        for (channel, profile, freq, phase, amp) in entries:
+            words.append((channel, profile) + self.dev.convertToWords(freq, phase, amp))
+        return await self.setProfilesWords(words, resetPhase=resetPhase, force=force)
+
+    async def setProfilesWords(self, entries, resetPhase=False, force=False):
+        async with self._getLock():
+            dirty, commands = self.dev.profileCommands(entries, force=force)
+            if not dirty:
+                return None
+
+            if resetPhase:
+                commands.append(self.dev.resetPhaseCommand())
+            # The shadow is updated when the command is queued, so that later
+            # writes are compared against what the device will hold
+            self.dev.updateShadow(dirty)
+            return self._enqueue(b''.join(commands))
+
+    async def resetPhase(self):
+        """Queues a phase reset. Returns its sequence number"""
+        async with self._getLock():
+            return self._enqueue(self.dev.resetPhaseCommand())
+
+    async def identity(self):
+        return await self._call("identity")
+
+    async def sync(self):
+        """Waits until the device has consumed all queued commands. Returns the
+        device sync token, see CoherentDds.sync"""
+        seq = self._seq
+        token = await self._call("sync")
+        self._acked = max(self._acked, seq)
+        return token
+
+    async def read_spi_word(self):
+        return await self._call("read_spi_word")
+
+    async def reset(self):
+        return await self._call("reset")
+
+    async def reconnect(self):
+        return await self._call("reconnect")
+
+    async def disableCoherenceMode(self, *args, **kwargs):
+        return await self._call("disableCoherenceMode", *args, **kwargs)
+
+    async def setClockSource(self, clock_internal=False):
+        return await self._call("setClockSource", clock_internal=clock_internal)
+
+    async def setPulseShape(self, shapeChannel, shapeVec, force=False):
+        return await self._call("setPulseShape", shapeChannel, shapeVec, force=force)
+
+    async def setSensiblePulseShape(self, duration, shapeChannel=0):
+        return await self._call("setSensiblePulseShape", duration,
+                                shapeChannel=shapeChannel)
+
+    async def setStandardPulseShape(self, duration, shape, shapeChannel=0,
+                                    force=False, **kwargs):
+        return await self._call("setStandardPulseShape", duration, shape,
+                                shapeChannel=shapeChannel, force=force, **kwargs)
+
+    async def loadScanTable(self, channel, freqs, phases=0.0, amps=1.0):
+        return await self._call("loadScanTable", channel, freqs, phases, amps)
+
+    async def loadScanPage(self, channel, page):
+        return await self._call("loadScanPage", channel, page)
+
+    def getScanPageSize(self):
+        return self.dev.getScanPageSize()
+
+    def get_lsb_freq(self):
+        return self.dev.get_lsb_freq()
+
+    def get_profile(self, channel, profile):
+        return self.dev.get_profile(channel, profile)
+
+    def get_shadow_stats(self):
+        return self.dev.get_shadow_stats()
+
+    def ping(self):
+        return True
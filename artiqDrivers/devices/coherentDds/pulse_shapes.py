@@ -0,0 +1,77 @@
+"""Pulse shape envelopes for the CoherentDds pulse shaping VGA.
+
+Each function returns the rising edge of the pulse as a NumPy array of n
+points between 0 and 1 (the firmware plays the edge backwards for the falling
+edge). One point is played per DDS sync clock cycle divided by 2, see
+samples_for_duration."""
+import numpy as np
+
+
+SAMPLE_RATE = 250e6/2 # /2 because clock used is divided by 2, 250MHz is DDS sync clk
+
+
+def samples_for_duration(duration):
+    """Number of shape points needed for a rising edge lasting 'duration' seconds"""
+    return int(round(duration*SAMPLE_RATE))
+
+
+def _edge(n):
+    """Points in (0,1] at which the edge is sampled, ending at full amplitude"""
+    return np.arange(1, n+1) / n
+
+
+def _normalise(y):
+    """Rescales y so that it runs from 0 at its first point to 1 at its last"""
+    return (y - y[0]) / (y[-1] - y[0]) if len(y) > 1 else np.ones_like(y)
+
+
+def _erf(x):
+    """Vectorised error function (Abramowitz & Stegun 7.1.26, max error 1.5e-7,
+    well below the 14 bit amplitude resolution)"""
+    sign = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911*x)
+    poly = t*(0.254829592 + t*(-0.284496736 + t*(1.421413741
+                + t*(-1.453152027 + t*1.061405429))))
+    return sign*(1 - poly*np.exp(-x*x))
+
+
+def sensible(n):
+    """The historical 'sensible looking' pulse shape: a clipped log-sin^4 edge"""
+    x = np.arange(1, n+1) / (n+1)
+    y = 0.209*np.log10(np.sin(x*np.pi/2)**4) + 1
+    return np.clip(y, 0, 1)
+
+
+def blackman(n):
+    """Rising half of a Blackman window"""
+    x = _edge(n)
+    return np.clip(0.42 - 0.5*np.cos(np.pi*x) + 0.08*np.cos(2*np.pi*x), 0, 1)
+
+
+def cos2(n):
+    """Rising half of a cos^2 (Hann) window"""
+    return np.sin(_edge(n)*np.pi/2)**2
+
+
+def gaussian(n, sigma=1/3):
+    """Rising edge of a Gaussian, sigma in units of the edge duration, offset
+    so that the edge starts at zero"""
+    x = np.concatenate(([0], _edge(n)))
+    return _normalise(np.exp(-0.5*((x-1)/sigma)**2))[1:]
+
+
+def erf(n, sigma=1/6):
+    """Error function edge centred on the middle of the edge, sigma in units of
+    the edge duration, offset so that the edge starts at zero"""
+    x = np.concatenate(([0], _edge(n)))
+    return _normalise(_erf((x-0.5)/(np.sqrt(2)*sigma)))[1:]
+
+
+shapes = {
+    "sensible": sensible,
+    "blackman": blackman,
+    "cos2": cos2,
+    "gaussian": gaussian,
+    "erf": erf,
+}
@@ -1,5 +1,6 @@
 from artiq.language.core import *
-from artiq_routines.hfQubitTransitionFreq import HfQubitTransitionFreq
+from artiqDrivers.devices.coherentDds.transition_freqs import transition_freqs
+import numpy as np
 
 
 class RamanDdsWrapperBase:
@@ -11,7 +12,8 @@ class RamanDdsWrapperBase:
 
         self.dds = dmgr.get(device)
         
-        self.hfq = HfQubitTransitionFreq()
+        # Shared, memoised transition frequencies
+        self.hfq = transition_freqs
         
         self.msDiff = 3.2e9 # master-slave Raman laser frequency difference
         self.trans = 't4030' # hyperfine transition without Zeeman shift
@@ -20,216 +22,156 @@ class RamanDdsWrapperBase:
         #self.rH_freq = -126e6 # frequency of Rh, is -1st order
     
 
-class RamanDdsWrapperPhaseNoise(RamanDdsWrapperBase):
-    """For high-field SBC and phase noise measurements"""
-    def __init__(self, dmgr, device):
-        """LO_freq : blue beat note frequency between master and slave laser"""
-        RamanDdsWrapperBase.__init__(self, dmgr, device)
-        # range of sensible frequencies for rPara and rV        
-        self.rParaRange = [70e6,120e6]
-        self.rVRange = [105e6,113e6]
-    
 
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq = True):
-        ''' channnel: rPara or rV, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz '''
-        if addQubitFreq:
-            freqDDS = self.msDiff+self.rH_freq-freq
-        else:
-            raise ValueError("This driver only supports addQubitFreq = True ")
-        
-        if channel == 'rPara':
+# Channel tables for the gate modes. For each logical channel:
+#   'dds_channel': DDS channel driving the AOM
+#   'range': [min, max] sensible DDS frequencies in Hz
+#   'divisor': the logical frequency and phase are divided by this, e.g. 2 for
+#       a double passed AOM
+#   'sign': sign of the diffraction order, -1 for a -1st order AOM
+#   'fixed': if not None, the channel runs at this fixed DDS frequency (Hz)
+# and for the mode:
+#   'gate_freq': DDS frequency that detunings are added to when addQubitFreq
+#       is False, or None if the mode only supports addQubitFreq=True
+MODES = {
+    # For high-field SBC and phase noise measurements
+    "phase_noise": {
+        "gate_freq": None,
+        "channels": {
             # rPara is double passed +1,+1
-            freqDDS /= 2
-            phase /= 2
-            if (freqDDS<self.rParaRange[0]) or (freqDDS>self.rParaRange[1]):
-                raise ValueError("Rpara frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rParaRange[0]/1e6,self.rParaRange[1]/1e6))
-            else:
-                self.dds.setProfile(0, profile, freqDDS, phase=phase, amp=amp)
-            
-        elif channel == 'rV':
-            # rV is -1st order  
-            freqDDS *= -1     
-            if (freqDDS<self.rVRange[0]) or (freqDDS>self.rVRange[1]):
-                raise ValueError("Rv frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rVRange[0]/1e6,self.rVRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-            
-        else:
-            raise ValueError("Channel can only be rPara or rV")
-            
-        self.dds.resetPhase()
-        
-class RamanDdsWrapper(RamanDdsWrapperBase):
-    """For fast gate measurements, incl high field SBC"""
-    def __init__(self, dmgr, device):
-        """LO_freq : blue beat note frequency between master and slave laser"""
+            "rPara": {"dds_channel": 0, "range": [70e6, 120e6], "divisor": 2, "sign": +1, "fixed": None},
+            # rV is -1st order
+            "rV": {"dds_channel": 1, "range": [105e6, 113e6], "divisor": 1, "sign": -1, "fixed": None},
+        },
+    },
+    # For fast gate measurements, incl high field SBC
+    "fast": {
+        "gate_freq": 200.368568e6,
+        "channels": {
+            "rPara": {"dds_channel": 0, "range": [140e6, 250e6], "divisor": 1, "sign": +1, "fixed": None},
+            # rV and rH2 are +1st order, and at fixed frequency
+            "rV": {"dds_channel": 1, "range": [190e6, 218e6], "divisor": 1, "sign": +1, "fixed": 200.368568e6},
+            "rH2": {"dds_channel": 1, "range": [213e6, 218e6], "divisor": 1, "sign": +1, "fixed": 217.309645e6},
+        },
+    },
+    # For fast gate measurements, incl high field SBC
+    "usual": {
+        "gate_freq": 217.368568e6,
+        "channels": {
+            "rPara": {"dds_channel": 0, "range": [140e6, 250e6], "divisor": 1, "sign": +1, "fixed": None},
+            "rV": {"dds_channel": 1, "range": [213e6, 218e6], "divisor": 1, "sign": +1, "fixed": 217.368568e6},
+            "rH2": {"dds_channel": 1, "range": [213e6, 218e6], "divisor": 1, "sign": +1, "fixed": 217.309645e6},
+        },
+    },
+    # For wobble gate measurements, incl high field SBC
+    "wobble": {
+        "gate_freq": 217.368568e6,
+        "channels": {
+            "rPara": {"dds_channel": 0, "range": [140e6, 250e6], "divisor": 1, "sign": +1, "fixed": None},
+            "rV": {"dds_channel": 1, "range": [213e6, 218e6], "divisor": 1, "sign": +1, "fixed": 217.368568e6},
+        },
+    },
+    # For Molmer Sorensen gate measurements, incl high field SBC, Rv is actually Rh2.
+    # RamanDdsWrapperMS sets rV to gate_freq + omegaZ
+    "ms": {
+        "gate_freq": 215e6,
+        "channels": {
+            "rPara": {"dds_channel": 0, "range": [70e6, 120e6], "divisor": 2, "sign": +1, "fixed": None},
+            "rV": {"dds_channel": 1, "range": [214e6, 216e6], "divisor": 1, "sign": +1, "fixed": 215e6 + 1.9e6},
+        },
+    },
+}
+
+
+class RamanDdsWrapperTable(RamanDdsWrapperBase):
+    """Table driven Raman DDS wrapper. The AOM arrangement is given either by
+    'mode', the name of one of the entries of MODES, or by explicit 'channels'
+    and 'gate_freq' arguments in the same format, so that it can be set up
+    entirely from the device db."""
+    def __init__(self, dmgr, device, mode=None, channels=None, gate_freq=None):
         RamanDdsWrapperBase.__init__(self, dmgr, device)
-        # range of sensible frequencies for rPara and rV
-        self.rParaRange = [140e6,250e6]
-        self.rVRange = [190e6,218e6]
-        self.rHRange = [213e6,218e6]
-    
+        if mode is not None:
+            if mode not in MODES:
+                raise ValueError("Unknown mode '{}', should be one of {}".format(
+                    mode, sorted(MODES)))
+            channels = MODES[mode]["channels"]
+            gate_freq = MODES[mode]["gate_freq"]
+        if channels is None:
+            raise ValueError("Either a mode or a channel table is needed")
+        self.channels = channels
+        self.gateFreq = gate_freq
 
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq = True):
-        ''' channnel: rPara or rV, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz '''
-        freqRv = 200.368568e6
-        freqRh2 = 217.309645e6
-        if addQubitFreq:
-            freqDDS = self.msDiff+self.rH_freq-freq
-        else:
-            freqDDS = freqRv + freq
-        
-        if channel == 'rPara':
-            # rPara is double passed +1,+1
-            if (freqDDS<self.rParaRange[0]) or (freqDDS>self.rParaRange[1]):
-                raise ValueError("Rpara frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rParaRange[0]/1e6,self.rParaRange[1]/1e6))
-            else:
-                self.dds.setProfile(0, profile, freqDDS, phase=phase, amp=amp)
-            
-        elif channel == 'rV':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRv
-            if (freqDDS<self.rVRange[0]) or (freqDDS>self.rVRange[1]):
-                raise ValueError("Rv frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rVRange[0]/1e6,self.rVRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-        elif channel == 'rH2':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRh2
-            if (freqDDS<self.rHRange[0]) or (freqDDS>self.rHRange[1]):
-                raise ValueError("RH2 frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rHRange[0]/1e6,self.rHRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
+    def compute_dds_frequencies(self, channel, freqs, addQubitFreq=True, fixedFreq=None):
+        """Returns the DDS frequencies for logical frequencies 'freqs' (scalar or
+        array) on 'channel', checking all points are in range in one pass.
+        fixedFreq overrides the frequency of fixed frequency channels"""
+        entry = self._entry(channel)
+        freqs = np.asarray(freqs, dtype=float)
+        if entry["fixed"] is not None or fixedFreq is not None:
+            fixed = entry["fixed"] if fixedFreq is None else fixedFreq
+            freqDDS = np.full(freqs.shape, fixed)
+        elif addQubitFreq:
+            freqDDS = entry["sign"]*(self.msDiff+self.rH_freq-freqs)/entry["divisor"]
+        elif self.gateFreq is None:
+            raise ValueError("This driver only supports addQubitFreq = True ")
         else:
-            raise ValueError("Channel can only be rPara, rH2 or rV")
-            
-        self.dds.resetPhase()
+            freqDDS = entry["sign"]*(self.gateFreq+freqs)/entry["divisor"]
+
+        lo, hi = entry["range"]
+        bad = (freqDDS < lo) | (freqDDS > hi)
+        if np.any(bad):
+            raise ValueError("{} frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(
+                channel, freqDDS[bad].flat[0]/1e6, lo/1e6, hi/1e6))
+        return freqDDS
+
+    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq=True,
+                   fixedFreq=None):
+        """channel: one of the channels in the table, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz"""
+        entry = self._entry(channel)
+        freqDDS = float(self.compute_dds_frequencies(channel, freq, addQubitFreq=addQubitFreq,
+                                                     fixedFreq=fixedFreq))
+        phase /= entry["divisor"]
+        if self.dds.setProfile(entry["dds_channel"], profile, freqDDS, phase=phase, amp=amp):
+            self.dds.resetPhase()
+
+    def _entry(self, channel):
+        if channel not in self.channels:
+            raise ValueError("Channel can only be {}".format(
+                ", ".join(sorted(self.channels))))
+        return self.channels[channel]
+
+
+class RamanDdsWrapperPhaseNoise(RamanDdsWrapperTable):
+    """For high-field SBC and phase noise measurements"""
+    def __init__(self, dmgr, device):
+        RamanDdsWrapperTable.__init__(self, dmgr, device, mode="phase_noise")
 
 
-class RamanDdsWrapperUsual(RamanDdsWrapperBase):
+class RamanDdsWrapper(RamanDdsWrapperTable):
     """For fast gate measurements, incl high field SBC"""
     def __init__(self, dmgr, device):
-        """LO_freq : blue beat note frequency between master and slave laser"""
-        RamanDdsWrapperBase.__init__(self, dmgr, device)
-        # range of sensible frequencies for rPara and rV
-        self.rParaRange = [140e6,250e6]
-        self.rVRange = [213e6,218e6]
-        self.rHRange = [213e6,218e6]
-    
+        RamanDdsWrapperTable.__init__(self, dmgr, device, mode="fast")
 
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq = True):
-        ''' channnel: rPara or rV, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz '''
-        freqRv = 217.368568e6
-        freqRh2 = 217.309645e6
-        if addQubitFreq:
-            freqDDS = self.msDiff+self.rH_freq-freq
-        else:
-            freqDDS = freqRv + freq
-        
-        if channel == 'rPara':
-            # rPara is double passed +1,+1
-            if (freqDDS<self.rParaRange[0]) or (freqDDS>self.rParaRange[1]):
-                raise ValueError("Rpara frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rParaRange[0]/1e6,self.rParaRange[1]/1e6))
-            else:
-                self.dds.setProfile(0, profile, freqDDS, phase=phase, amp=amp)
-            
-        elif channel == 'rV':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRv
-            if (freqDDS<self.rVRange[0]) or (freqDDS>self.rVRange[1]):
-                raise ValueError("Rv frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rVRange[0]/1e6,self.rVRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-        elif channel == 'rH2':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRh2
-            if (freqDDS<self.rHRange[0]) or (freqDDS>self.rHRange[1]):
-                raise ValueError("RH2 frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rHRange[0]/1e6,self.rHRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-        else:
-            raise ValueError("Channel can only be rPara, rH2 or rV")
-            
-        self.dds.resetPhase()
 
+class RamanDdsWrapperUsual(RamanDdsWrapperTable):
+    """For fast gate measurements, incl high field SBC"""
+    def __init__(self, dmgr, device):
+        RamanDdsWrapperTable.__init__(self, dmgr, device, mode="usual")
 
-        
-class RamanDdsWrapperWobble(RamanDdsWrapperBase):
+
+class RamanDdsWrapperWobble(RamanDdsWrapperTable):
     """For wobble gate measurements, incl high field SBC"""
     def __init__(self, dmgr, device):
-        """LO_freq : blue beat note frequency between master and slave laser"""
-        RamanDdsWrapperBase.__init__(self, dmgr, device)
-        # range of sensible frequencies for rPara and rV        
-        self.rParaRange = [140e6,250e6]
-        self.rVRange = [213e6,218e6]
-    
+        RamanDdsWrapperTable.__init__(self, dmgr, device, mode="wobble")
 
-    def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq = True):
-        ''' channnel: rPara or rV, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz '''
-        freqRv = 217.368568e6
-        if addQubitFreq:
-            freqDDS = self.msDiff+self.rH_freq-freq
-        else:
-            freqDDS = freqRv + freq
-        
-        if channel == 'rPara':
-            # rPara is double passed +1,+1
-            if (freqDDS<self.rParaRange[0]) or (freqDDS>self.rParaRange[1]):
-                raise ValueError("Rpara frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rParaRange[0]/1e6,self.rParaRange[1]/1e6))
-            else:
-                self.dds.setProfile(0, profile, freqDDS, phase=phase, amp=amp)
-            
-        elif channel == 'rV':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRv
-            if (freqDDS<self.rVRange[0]) or (freqDDS>self.rVRange[1]):
-                raise ValueError("Rv frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rVRange[0]/1e6,self.rVRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-            
-        else:
-            raise ValueError("Channel can only be rPara or rV")
-            
-        self.dds.resetPhase()
-        
-class RamanDdsWrapperMS(RamanDdsWrapperBase):
+
+class RamanDdsWrapperMS(RamanDdsWrapperTable):
     """For Molmer Sorensen gate measurements, incl high field SBC, Rv is actually Rh2"""
     def __init__(self, dmgr, device):
-        """LO_freq : blue beat note frequency between master and slave laser"""
-        RamanDdsWrapperBase.__init__(self, dmgr, device)
-        # range of sensible frequencies for rPara and rV        
-        self.rParaRange = [70e6,120e6]
-        self.rVRange = [214e6,216e6]
-    
+        RamanDdsWrapperTable.__init__(self, dmgr, device, mode="ms")
 
     def setProfile(self, channel, profile, freq, phase=0.0, amp=1.0, addQubitFreq = True, omegaZ = 1.9e6):
         ''' channnel: rPara or rV, profile: 0...7, if addQubitFreq=True: the lasers used to create the frequency difference are split by 3.2GHz '''
-        if addQubitFreq:
-            freqDDS = self.msDiff+self.rH_freq-freq
-        else:
-            freqRv0 = 215e6
-            freqRv1 = freqRv0 + omegaZ
-            freqRv2 = freqRv0 - omegaZ
-            freqDDS = freqRv0 + freq
-        
-        if channel == 'rPara':
-            # rPara is double passed +1,+1
-            freqDDS /= 2
-            phase /= 2
-            if (freqDDS<self.rParaRange[0]) or (freqDDS>self.rParaRange[1]):
-                raise ValueError("Rpara frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rParaRange[0]/1e6,self.rParaRange[1]/1e6))
-            else:
-                self.dds.setProfile(0, profile, freqDDS, phase=phase, amp=amp)
-            
-        elif channel == 'rV':
-            # rV is +1st order, and at fixed frequency  
-            freqDDS = freqRv1 #TODO make 2 sidebands work    
-            if (freqDDS<self.rVRange[0]) or (freqDDS>self.rVRange[1]):
-                raise ValueError("Rv frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(freqDDS/1e6,self.rVRange[0]/1e6,self.rVRange[1]/1e6))
-            else:
-                self.dds.setProfile(1, profile, freqDDS, phase=phase, amp=amp)
-            
-        else:
-            raise ValueError("Channel can only be rPara or rV")
-            
-        self.dds.resetPhase()
\ No newline at end of file
+        fixedFreq = self.gateFreq + omegaZ if channel == 'rV' else None #TODO make 2 sidebands work
+        RamanDdsWrapperTable.setProfile(self, channel, profile, freq, phase=phase, amp=amp,
+                                        addQubitFreq=addQubitFreq, fixedFreq=fixedFreq)
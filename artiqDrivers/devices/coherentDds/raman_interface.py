@@ -2,6 +2,8 @@ from artiq.language.core import *
 from artiq.language.units import *
 import numpy as np
 import time
+from artiqDrivers.devices.dds_conversion import DdsConversion
+from artiqDrivers.devices.coherentDds.transition_freqs import transition_freqs
 
 
 
@@ -25,19 +27,44 @@ class AOM:
         self.order = order
         self.dds = dds
 
-    def _set_dds(self, frequency, profile, amplitude, phase,dds):
+    def _dds_params_array(self, frequency, phase):
+        """As _dds_params, but for arrays, checking all points in one pass"""
+        freq_dds = np.asarray(frequency, dtype=float)/self.order
+        phase_dds = np.asarray(phase, dtype=float)/self.order
+
+        bad = (freq_dds < self.range[0]) | (freq_dds > self.range[1])
+        if np.any(bad):
+            raise ValueError("{} AOM frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(self.name,freq_dds[bad].flat[0] / 1e6, self.range[0] / 1e6, self.range[1] / 1e6))
+        return freq_dds, phase_dds
 
+    def _dds_params(self, frequency, phase):
+        """Returns the DDS frequency and phase, checking the frequency is in range"""
         freq_dds = frequency/self.order
         phase_dds = phase/self.order
 
         if self.range[0] <= freq_dds <= self.range[1]:
-            #ftw = dds.frequency_to_ftw(freq_dds)
-            dds.set(freq_dds, profile = profile, amplitude = amplitude, phase = phase_dds)
-            #dds.set_mu(ftw, profile = profile, amplitude = amplitude, phase = phase_dds)
-            #print("set {} profile {} to freq {}, amp {}".format(self.name,profile,freq_dds,amplitude))
+            return freq_dds, phase_dds
         else:
             raise ValueError("{} AOM frequency out of range, {:.0f}MHz not in [{:.0f},{:.0f}]MHz".format(self.name,freq_dds / 1e6, self.range[0] / 1e6, self.range[1] / 1e6))
 
+    def _set_dds(self, frequency, profile, amplitude, phase,dds):
+        freq_dds, phase_dds = self._dds_params(frequency, phase)
+        #ftw = dds.frequency_to_ftw(freq_dds)
+        dds.set(freq_dds, profile = profile, amplitude = amplitude, phase = phase_dds)
+        #dds.set_mu(ftw, profile = profile, amplitude = amplitude, phase = phase_dds)
+        #print("set {} profile {} to freq {}, amp {}".format(self.name,profile,freq_dds,amplitude))
+
+    def to_mu(self, frequency, amplitude=1, phase=0):
+        """Returns the (ftw, asf, pow) DDS words for a tone"""
+        freq_dds, phase_dds = self._dds_params(frequency, phase)
+        return self.dds.to_mu(freq_dds, amplitude=amplitude, phase=phase_dds)
+
+    def allocate(self, frequency, amplitude=1, phase=0):
+        """Returns a DDS profile holding the given tone, writing it only if it
+        is not already resident"""
+        freq_dds, phase_dds = self._dds_params(frequency, phase)
+        return self.dds.allocate_profile(freq_dds, amplitude=amplitude, phase=phase_dds)
+
     def set(self, frequency, profile=0, amplitude=1, phase=0):
         self._set_dds(frequency, profile=profile, amplitude=amplitude, phase=phase,dds=self.dds)
 
@@ -53,9 +80,19 @@ class RamanAOM(AOM):
         self.rH_freq = -109e6 # frequency of Rh, is -1st order, =self.rV_freq+hfq.df_trans(mF4=4,mF3=3)-self.ms_diff
         self.rH2_freq = 217.309632e6 # frequency of Rh2, is +1st order, =self.rV_freq+hfq.df_trans(mF4=0,mF3=1)-self.ms_diff
         self.rHSr_freq = -192.0537339091928e6 # sr qubit freq = sr88.zeeman_splitting_146G = 409422288.9091928, rHSr_freq = rV_freq - sr qubit freq (with measured 6 kHz offset included) # in set_dds, freq_dds = freq/order, so needs to be -ve here
+        self.sr_qubit_freq = self.rV_freq - self.rHSr_freq
 
         super().__init__(name,freq_range,order,dds)
 
+    def update_field(self, B=None, cache=transition_freqs):
+        """Recomputes rV_freq, rH2_freq and rHSr_freq for the Ca+ transition
+        frequencies at field B (None for the default field), using the shared
+        transition frequency cache. rH_freq and the Sr qubit frequency are
+        kept fixed"""
+        self.rV_freq = self.ms_diff+self.rH_freq-cache.df_trans(B=B,mF4=4,mF3=3)
+        self.rH2_freq = self.rV_freq+cache.df_trans(B=B,mF4=0,mF3=1)-self.ms_diff
+        self.rHSr_freq = self.rV_freq-self.sr_qubit_freq
+
     def calculate_dds_frequency(self,frequency,add_qubit_freq=True,on_clock=False,on_sr=False):
         if (self.name == 'rPara') or (self.name == 'rParaB'):
             if add_qubit_freq:
@@ -87,12 +124,43 @@ class RamanAOM(AOM):
         freqDDS = self.calculate_dds_frequency(frequency,add_qubit_freq=add_qubit_freq,on_clock=on_clock,on_sr=on_sr)
         super().set(frequency=freqDDS, profile=profile, amplitude=amplitude, phase=phase)
 
+    def to_mu(self, frequency, amplitude=1, phase=0, add_qubit_freq=True, on_clock=False, on_sr=False):
+        freqDDS = self.calculate_dds_frequency(frequency,add_qubit_freq=add_qubit_freq,on_clock=on_clock,on_sr=on_sr)
+        return super().to_mu(freqDDS, amplitude=amplitude, phase=phase)
+
+    def allocate(self, frequency, amplitude=1, phase=0, add_qubit_freq=True, on_clock=False, on_sr=False):
+        freqDDS = self.calculate_dds_frequency(frequency,add_qubit_freq=add_qubit_freq,on_clock=on_clock,on_sr=on_sr)
+        return super().allocate(freqDDS, amplitude=amplitude, phase=phase)
+
     def _direct_set(self, frequency, profile=0, amplitude=1, phase=0):
         # use this only for debugging purposes, tp directly program in a dds frequency
         super().set(frequency=frequency, profile=profile, amplitude=amplitude, phase=phase)
 
 
 
+class CompiledScan:
+    """
+    A scan precompiled by RamanInterface.compile_scan: the DDS frequency, phase
+    and amplitude words of every point, already LSB-rounded and range-checked.
+    'frequencies' holds the DDS frequencies actually produced.
+    """
+    def __init__(self, dds, freq_words, phase_words, amp_words, frequencies):
+        self.dds = dds
+        self.freq_words = freq_words
+        self.phase_words = phase_words
+        self.amp_words = amp_words
+        self.frequencies = frequencies
+
+    def __len__(self):
+        return len(self.freq_words)
+
+    def apply(self, index, profile=1):
+        """Writes point 'index' to the DDS profile, with a single RPC"""
+        return self.dds.set_mu(int(self.freq_words[index]), profile=profile,
+                               asf=int(self.amp_words[index]),
+                               pow_=int(self.phase_words[index]))
+
+
 class RamanInterface:
     """
     Wrapper which allows logical frequencies offsets from the 674 carrier to
@@ -106,6 +174,7 @@ class RamanInterface:
 
         dds = dmgr.get(dds_device)
         self.core = dmgr.get("core")
+        self.dds = dds
 
         assert(dds._ch1.get_lsb_freq() == dds._ch2.get_lsb_freq() == dds._ch3.get_lsb_freq() == dds._ch4.get_lsb_freq()) #4 channels of the same DDS. Sanity check, set up in device db
         self.lsb = dds._ch1.get_lsb_freq()
@@ -120,6 +189,14 @@ class RamanInterface:
         #self.total_sp_amp = 0.35 #Old value so that we don't see higher harmonics when driving with 2 tones
         self.total_sp_amp = 1 # Gets more optical power
 
+        # Field passed to update_field, if the frequency plan follows the
+        # transition frequency cache rather than the hard-coded frequencies
+        self._field = None
+        self._field_tracked = False
+        # Held by weak reference, so the interface is not kept alive by the
+        # process-wide cache
+        transition_freqs.add_invalidate_hook(self._on_transitions_invalidated)
+
 
     @kernel
     def set_to_profile(self,channel,profile,delay=True):
@@ -136,37 +213,90 @@ class RamanInterface:
             raise ValueError("set_to_profile() not implemented for channel")
 
 
+    @kernel
+    def set_to_profiles(self, channels, profiles, delay=True):
+        """Switch several DdsChannels (e.g. [self.rPara.dds, self.rParaB.dds])
+        to the given profiles at the same time, see DdsGroup.use_profiles"""
+        self.dds.use_profiles(channels, profiles, delay=delay)
+
     @kernel
     def reset_phase(self):
-        #TODO check, which channels/ simultaneously? we need to switch channels
-        self.rPara.dds.reset_phase()
-        self.rH2.dds.reset_phase()
-        #self.rV.dds.reset_phase()
-        self.rHSr.dds.reset_phase()
-        self.rParaB.dds.reset_phase()
+        # One simultaneous reset per DDS board rather than one per channel
+        self.dds.reset_phase_channels([self.rPara.dds, self.rH2.dds,
+                                       self.rHSr.dds, self.rParaB.dds])
 
     def serial_reset_phase(self):
-        self.rPara.dds.serial_reset_phase()
-        self.rH2.dds.serial_reset_phase()
-        #self.rV.dds.serial_reset_phase()
-        self.rHSr.dds.serial_reset_phase()
-        self.rParaB.dds.serial_reset_phase()
+        # One reset per physical DDS, rather than one per channel
+        self.dds.serial_reset_phase([self.rPara.dds, self.rH2.dds,
+                                     self.rHSr.dds, self.rParaB.dds])
 
     def _lsb_round(self,freq):
         """Rounds to nearest LSB freq of the DDS, i.e. the actual frequency produced by the DDS. """
         return int(round(freq/self.lsb))*self.lsb
 
+    def _aom(self, channel):
+        if channel == 'rPara':
+            return self.rPara
+        elif channel == 'rParaB':
+            return self.rParaB
+        elif channel == 'rH2':
+            return self.rH2
+        elif channel == 'rHSr':
+            return self.rHSr
+        else:
+            raise ValueError("Unknown channel '{}'".format(channel))
+
+    def compile_scan(self, channel, frequencies, amplitudes=1, phases=0, **flags):
+        """Precomputes a whole scan on a channel, returning a CompiledScan whose
+        apply(index, profile) writes one point with a single RPC.
+        frequencies, amplitudes and phases are broadcast against each other.
+        flags (add_qubit_freq, on_clock, on_sr) are as for set_profile. All
+        points are LSB-rounded and range-checked up front"""
+        aom = self._aom(channel)
+        frequencies, amplitudes, phases = np.broadcast_arrays(
+            np.asarray(frequencies, dtype=float), amplitudes, phases)
+        rounded = np.round(frequencies/self.lsb)*self.lsb
+        freq_dds = aom.calculate_dds_frequency(rounded, **flags)
+        freq_dds = np.broadcast_to(freq_dds, rounded.shape)
+        freq_dds, phase_dds = aom._dds_params_array(freq_dds, phases)
+
+        conversion = DdsConversion.fromLsbFreq(self.lsb)
+        freq_words, phase_words, amp_words = conversion.toWords(
+            freq_dds, phase_dds, amplitudes)
+        return CompiledScan(aom.dds, freq_words, phase_words, amp_words,
+                            freq_words*self.lsb)
+
+    def _sync(self, aoms):
+        """Waits until the DDSs driving 'aoms' have processed all commands.
+        Each logical operation syncs once at its end, with a single sync per
+        physical DDS however many channels it wrote"""
+        if aoms:
+            self.dds.sync([aom.dds for aom in aoms])
+
+    def update_field(self, B=None):
+        """Recomputes the frequency plan of all AOMs for field B (None for the
+        default field). Transition frequencies come from the shared cache, so
+        calling this every shot only costs a dictionary lookup per transition
+        once a field has been seen. The plan is recomputed automatically if the
+        cache is invalidated"""
+        for aom in (self.rPara, self.rParaB, self.rH2, self.rHSr):
+            aom.update_field(B)
+        self._field = B
+        self._field_tracked = True
+
+    def _on_transitions_invalidated(self):
+        if self._field_tracked:
+            self.update_field(self._field)
+
     def set_profile(self, channel, frequency, profile=1, amplitude=1, phase=0,
                     add_qubit_freq=True, on_clock=False, on_sr=False):
         """Set profile"""
         if channel == 'rPara':
             self.rPara.set(self._lsb_round(frequency),profile=profile, amplitude=amplitude, phase=phase,
                             add_qubit_freq=add_qubit_freq, on_clock=on_clock, on_sr=on_sr)
-            self.rPara.identity()
 
         elif channel == 'rH2':
             self.rH2.set(self._lsb_round(frequency),profile=profile, amplitude=amplitude, phase=phase)
-            self.rH2.identity()
 
         elif channel == 'rV':
             raise ValueError("DDS channel rV repurposed as rHSr")
@@ -175,34 +305,40 @@ class RamanInterface:
 
         elif channel == 'rHSr':
             self.rHSr.set(self._lsb_round(frequency),profile=profile, amplitude=amplitude, phase=phase, add_qubit_freq=add_qubit_freq, on_clock=on_clock, on_sr=on_sr)
-            self.rHSr.identity()
 
         elif channel == 'rParaB':
             self.rParaB.set(self._lsb_round(frequency),profile=profile, amplitude=amplitude, phase=phase,
                             add_qubit_freq=add_qubit_freq, on_clock=on_clock)
-            self.rParaB.identity()
 
         else:
             raise ValueError("Unknown channel '{}'".format(channel))
+        self._sync([self._aom(channel)])
 
 
+    def allocate_profile(self, channel, frequency, amplitude=1, phase=0,
+                         add_qubit_freq=True, on_clock=False, on_sr=False):
+        """Returns a profile holding the requested tone, to be passed to
+        set_to_profile. Frequently used tones stay resident in the DDS profiles
+        and only new tones are written to the DDS"""
+        aom = self._aom(channel)
+        return aom.allocate(self._lsb_round(frequency), amplitude=amplitude, phase=phase,
+                            add_qubit_freq=add_qubit_freq, on_clock=on_clock, on_sr=on_sr)
+
     def debug_set_profile(self, frequency, profile=0, laser='rPara'):
         """Set profile"""
         if laser == 'rPara':
             self.rPara._direct_set(frequency,profile=profile)
-            self.rPara.identity()
         if laser == 'rH2':
             self.rH2._direct_set(frequency,profile=profile)
-            self.rH2.identity()
         if laser == 'rV':
             raise ValueError("DDS channel rV repurposed as rHSr")
             #self.rV._direct_set(frequency,profile=profile)
             #self.rV.identity()
         if laser == 'rHSr':
             self.rHSr._direct_set(frequency,profile=profile)
-            self.rHSr.identity()
         if (laser != 'rPara') and (laser != 'rH2') and (laser != 'rV') and (laser != 'rHSr'):
             raise ValueError("Unknown laser '{}'".format(laser))
+        self._sync([self._aom(laser)])
 
     def make_safe(self):
         """Prevents second channel connected to bichromatic AOM outputting RF, which may cause total RF power to exceed the AOM's damage threshold"""
@@ -213,15 +349,15 @@ class RamanInterface:
         if pulse_shape_duration == 0:
             return
         else:
-            self.rH2.dds.set_sensible_pulse_shape(pulse_shape_duration) #takes about 200ms
-            self.rH2.identity()
-            self.rHSr.dds.set_sensible_pulse_shape(pulse_shape_duration)
-            self.rHSr.identity()
+            # Uploading takes about 200ms, but is skipped by the driver if
+            # the channel already holds this shape
+            uploaded = [aom for aom in (self.rH2, self.rHSr)
+                        if aom.dds.set_sensible_pulse_shape(pulse_shape_duration)]
+            self._sync(uploaded)
 
     @kernel
     def pulse_shape_on(self):
-        self.rH2.dds.pulse_enable(1)
-        self.rHSr.dds.pulse_enable(1)
+        self.dds.pulse_enable_channels([self.rH2.dds, self.rHSr.dds], 1)
 
     @kernel
     def pulse_shape_pulse(self,t):
@@ -231,13 +367,16 @@ class RamanInterface:
 
     @kernel
     def pulse_shape_off(self):
-        self.rH2.dds.pulse_enable(0)
-        self.rHSr.dds.pulse_enable(0)
+        self.dds.pulse_enable_channels([self.rH2.dds, self.rHSr.dds], 0)
 
     def set_bichromat(self,sideband_freq, phase = 0, rPara_profile=1,
                       rParaB_profile=1, RSB_amp = None, BSB_amp = None,
                       phase_common = 0):
-        """Sets up the dds channels to output a symmetric bi-chromatic tone on the rPara AOM"""
+        """Sets up the dds channels to output a symmetric bi-chromatic tone on the rPara AOM.
+        Both sideband profiles are written as one batch per physical DDS, with
+        one phase reset and one acknowledgement. Profiles which already hold
+        the requested words are skipped by the driver, so repeating an
+        unchanged setup sends nothing"""
 
         imbalance_param = 0.8
 
@@ -258,9 +397,8 @@ class RamanInterface:
 
         #assert(np.sqrt(RSB_amp**2 + BSB_amp**2) <= 1.0)
 
-        self.rPara.set (-rounded_sideband_freq,profile=rPara_profile,  amplitude = BSB_amp, phase=phase+phase_common, add_qubit_freq=False) #BSB
-        self.rParaB.set(rounded_sideband_freq,profile=rParaB_profile, amplitude = RSB_amp, phase=-phase+phase_common, add_qubit_freq=False) #RSB
-
-        self.rPara.identity() # check if finished
-        self.rParaB.identity()
+        bsb = self.rPara.to_mu(-rounded_sideband_freq, amplitude = BSB_amp, phase=phase+phase_common, add_qubit_freq=False) #BSB
+        rsb = self.rParaB.to_mu(rounded_sideband_freq, amplitude = RSB_amp, phase=-phase+phase_common, add_qubit_freq=False) #RSB
+        self.dds.set_mu_batch([(self.rPara.dds, rPara_profile) + bsb,
+                               (self.rParaB.dds, rParaB_profile) + rsb])
 
@@ -0,0 +1,184 @@
+"""Host-side model of the CoherentDds firmware, used by CoherentDdsSim in place
+of the serial port.
+
+The model understands both the ASCII and the binary protocols and keeps the
+state the firmware would hold: the profile register file, the pulse shape
+memory and the phase accumulators. Every command is appended to a trace, and
+the time the serial link would take is accumulated on a simulated clock:
+each byte costs 10 bit periods (8N1) at the configured baud rate, each
+command a fixed processing time, and each reply a fixed turnaround latency
+(typically dominated by the USB-serial adapter) plus its own bytes."""
+import struct
+import numpy as np
+
+
+class SimulatedFirmware:
+    """Serial port lookalike (write/readline/close) backed by a model of the
+    firmware"""
+    def __init__(self, clockFreq, baudrate=115200, binary=True, sync=True,
+                 latency=1e-3, commandTime=10e-6):
+        # binary, sync: whether the firmware advertises the binary protocol and
+        #   the sync command
+        # latency: turnaround time of a query, in seconds
+        # commandTime: time the firmware takes to process a command, in seconds
+        self.clockFreq = clockFreq
+        self.baudrate = baudrate
+        self.binary = binary
+        self.sync = sync
+        self.latency = latency
+        self.commandTime = commandTime
+
+        self.time = 0.0 # simulated seconds since the port was opened
+        self.trace = [] # (time, command, arguments) for every command
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.roundTrips = 0
+        self.commands = 0
+
+        self._rx = b'' # bytes written but not yet parsed
+        self._replies = []
+        self._shapeChannel = None # set while waiting for pulse shape data
+        self._resetState()
+
+    def _resetState(self):
+        # (freq, phase, amp) words of each profile
+        self.profiles = np.zeros((4, 8, 3), dtype=np.int64)
+        # Quantised pulse shape of each shape channel
+        self.pulseShapes = [np.zeros(0, dtype=np.uint16) for _ in range(4)]
+        # Simulated time of the last phase reset of each channel
+        self.phaseResetTime = [0.0]*4
+        self.clockInternal = False
+        self.incoherent = [False]*4
+
+    def identity(self):
+        tags = ["CoherentDds", "simulation"]
+        if self.binary:
+            tags.append("binproto")
+        if self.sync:
+            tags.append("sync")
+        return " ".join(tags)
+
+    def write(self, data):
+        data = bytes(data)
+        self.bytesWritten += len(data)
+        self.time += self._byteTime(len(data))
+        self._rx += data
+        self._parse()
+        return len(data)
+
+    def readline(self):
+        if not self._replies:
+            # The real port would block until its timeout
+            raise IOError("Simulated CoherentDds read with no reply pending")
+        line = self._replies.pop(0)
+        self.bytesRead += len(line)
+        self.roundTrips += 1
+        self.time += self.latency + self._byteTime(len(line))
+        return line
+
+    def close(self):
+        pass
+
+    def phase(self, channel, profile, t=None):
+        """Returns the output phase (turns) the channel would have on the given
+        profile at simulated time t (default now), given the last phase reset"""
+        if t is None:
+            t = self.time
+        freq, phase, _ = self.profiles[channel, profile]
+        turns = freq / 2**32 * self.clockFreq * (t - self.phaseResetTime[channel])
+        return (turns + phase / 65536) % 1.0
+
+    def _byteTime(self, n):
+        return n * 10 / self.baudrate
+
+    def _reply(self, text):
+        self._replies.append(text.encode() + b'\n')
+
+    def _record(self, command, *args):
+        self.commands += 1
+        self.time += self.commandTime
+        self.trace.append((self.time, command, args))
+
+    def _parse(self):
+        while self._rx:
+            if self._shapeChannel is not None:
+                if b'\n' not in self._rx:
+                    return
+                line, self._rx = self._rx.split(b'\n', 1)
+                shape = np.array([int(v) for v in line.decode().split(',')],
+                                 dtype=np.uint16)
+                self._setPulseShape(self._shapeChannel, shape)
+                self._shapeChannel = None
+            elif self.binary and self._rx[0] == 0xb5:
+                if len(self._rx) < 4:
+                    return
+                opcode, length = struct.unpack('<BH', self._rx[1:4])
+                if len(self._rx) < 5 + length:
+                    return
+                frame, self._rx = self._rx[:5 + length], self._rx[5 + length:]
+                if sum(frame[1:]) & 0xff:
+                    raise ValueError("Bad checksum in frame {}".format(frame.hex()))
+                self._frame(opcode, frame[4:-1])
+            else:
+                if b'\n' not in self._rx:
+                    return
+                line, self._rx = self._rx.split(b'\n', 1)
+                self._line(line.decode().strip())
+
+    def _frame(self, opcode, payload):
+        if opcode == 0x01:
+            self._setProfile(*struct.unpack('<BBIHH', payload))
+        elif opcode == 0x02:
+            self._resetPhase()
+        elif opcode == 0x03:
+            self._setPulseShape(payload[0],
+                                np.frombuffer(payload[1:], dtype='<u2').astype(np.uint16))
+        else:
+            raise ValueError("Unknown binary opcode {}".format(opcode))
+
+    def _line(self, line):
+        if not line:
+            return
+        command, *args = line.split()
+        if command == 'setProfile':
+            self._setProfile(*(int(a) for a in args))
+        elif command == 'resetPhase':
+            self._resetPhase()
+        elif command == 'setPulseShape':
+            self._record('setPulseShapeHeader', int(args[0]))
+            self._shapeChannel = int(args[0])
+        elif command == 'idn?':
+            self._record('idn?')
+            self._reply(self.identity())
+        elif command == 'sync':
+            self._record('sync', int(args[0]))
+            self._reply(args[0])
+        elif command == 'getSpiWord?':
+            self._record('getSpiWord?')
+            self._reply('0')
+        elif command == 'setDisableCoherence':
+            self.incoherent = [bool(int(a)) for a in args]
+            self._record('setDisableCoherence', *self.incoherent)
+            self._reply('OK')
+        elif command == 'setClockSource':
+            self.clockInternal = bool(int(args[0]))
+            self._record('setClockSource', self.clockInternal)
+            self._reply('OK')
+            self._reply('OK')
+        elif command == 'reset':
+            self._record('reset')
+            self._resetState()
+        else:
+            raise ValueError("Unknown command '{}'".format(line))
+
+    def _setProfile(self, channel, profile, freq, phase, amp):
+        self._record('setProfile', channel, profile, freq, phase, amp)
+        self.profiles[channel, profile] = (freq, phase, amp)
+
+    def _resetPhase(self):
+        self._record('resetPhase')
+        self.phaseResetTime = [self.time]*4
+
+    def _setPulseShape(self, channel, shape):
+        self._record('setPulseShape', channel, len(shape))
+        self.pulseShapes[channel] = shape
@@ -0,0 +1,80 @@
+import weakref
+
+
+class TransitionFreqCache:
+    """Memoised hyperfine qubit transition frequencies, keyed by (B, mF4, mF3).
+
+    Evaluating HfQubitTransitionFreq.df_trans diagonalises the Breit-Rabi
+    Hamiltonian, so frequency plans which are recomputed every shot look the
+    transitions up here instead. B=None means the default field of
+    HfQubitTransitionFreq.
+
+    invalidate() drops every cached frequency, e.g. after the field or the
+    atomic constants have been recalibrated, and then calls the callbacks
+    registered with add_invalidate_hook so that dependent frequency plans can
+    be recomputed. Hooks which are bound methods are held by weak reference,
+    so that the cache, which lives as long as the process, does not keep
+    their objects alive."""
+    def __init__(self, hfq=None):
+        # HfQubitTransitionFreq instance, created on first use
+        self._hfq = hfq
+        self._freqs = {}
+        self._hooks = []
+        self.hits = 0
+        self.misses = 0
+
+    def _get_hfq(self):
+        if self._hfq is None:
+            from artiq_routines.hfQubitTransitionFreq import HfQubitTransitionFreq
+            self._hfq = HfQubitTransitionFreq()
+        return self._hfq
+
+    def df_trans(self, B=None, mF4=4, mF3=3):
+        """Returns the frequency (Hz) of the transition between the F=4, mF4 and
+        F=3, mF3 states at field B"""
+        key = (None if B is None else float(B), int(mF4), int(mF3))
+        try:
+            freq = self._freqs[key]
+            self.hits += 1
+            return freq
+        except KeyError:
+            pass
+        self.misses += 1
+        if B is None:
+            freq = self._get_hfq().df_trans(mF4=key[1], mF3=key[2])
+        else:
+            freq = self._get_hfq().df_trans(B=key[0], mF4=key[1], mF3=key[2])
+        self._freqs[key] = freq
+        return freq
+
+    def invalidate(self):
+        """Forgets all cached frequencies and calls the invalidate hooks"""
+        self._freqs = {}
+        for ref in list(self._hooks):
+            hook = ref()
+            if hook is None:
+                self._hooks.remove(ref)
+            else:
+                hook()
+
+    def add_invalidate_hook(self, hook):
+        """Registers a callable, taking no arguments, to be called on invalidate()"""
+        if hasattr(hook, "__self__") and hasattr(hook, "__func__"):
+            ref = weakref.WeakMethod(hook)
+        else:
+            ref = lambda: hook
+        self._hooks.append(ref)
+
+    def remove_invalidate_hook(self, hook):
+        for ref in self._hooks:
+            if ref() == hook:
+                self._hooks.remove(ref)
+                return
+        raise ValueError("Hook not registered")
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._freqs)}
+
+
+# Cache shared by all the Raman wrappers in a process
+transition_freqs = TransitionFreqCache()
@@ -0,0 +1,109 @@
+from artiqDrivers.devices.dds_shadow import ProfileShadow
+from artiqDrivers.devices.dds_conversion import DdsConversion
+
+
+class DdsBase:
+    """Common part of the serial DDS drivers: word conversion and validation,
+    the shadow registers used to skip redundant writes, and batched profile
+    writes.
+
+    Subclasses set nChannels and provide the transport:
+        _profileCommand(channel, profile, freq, phase, amp): returns the bytes
+            which set a profile to the given words
+        _sendBatch(commands): sends a list of commands (bytes) and waits until
+            the device has processed all of them
+    """
+    lsbAmp = DdsConversion.lsbAmp
+    lsbPhase = DdsConversion.lsbPhase
+    nChannels = 1
+    nProfiles = 8
+
+    def __init__(self, clockFreq):
+        self.lsbFreq = clockFreq / (2**32);
+        self.clockFreq = clockFreq
+        self.conversion = DdsConversion(clockFreq)
+        # Words last written to each profile
+        self.shadow = ProfileShadow(self.nChannels, self.nProfiles)
+
+    def _profileCommand(self, channel, profile, freq, phase, amp):
+        raise NotImplementedError
+
+    def _sendBatch(self, commands):
+        raise NotImplementedError
+
+    def _writeProfiles(self, entries, force=False, extraCommands=()):
+        """Writes (channel, profile, freq, phase, amp) entries, in units of lsb,
+        with a single _sendBatch, see profileCommands. extraCommands are
+        appended to the batch if anything is sent. Returns the number of
+        profiles written"""
+        dirty, commands = self.profileCommands(entries, force=force)
+        if not dirty:
+            return 0
+        self._sendBatch(commands + list(extraCommands))
+        self.updateShadow(dirty)
+        return len(dirty)
+
+    def profileCommands(self, entries, force=False):
+        """Returns the commands which write (channel, profile, freq, phase, amp)
+        entries, in units of lsb, without sending them. The whole table is
+        validated first, and profiles which already hold the requested words
+        are skipped unless force is True. Returns (dirty, commands), where
+        dirty lists the (channel, profile, words) written by the commands, to be
+        passed to updateShadow once they have been sent"""
+        dirty = []
+        for (channel, profile, freq, phase, amp) in entries:
+            profile = int(profile) # have to do this, because artiq uses a special artiq.integer
+            self._checkProfileWords(channel, profile, freq, phase, amp)
+            words = (freq, phase, amp)
+            if force or self.shadow.isDirty(channel, profile, words):
+                dirty.append((channel, profile, words))
+        commands = [self._profileCommand(channel, profile, *words)
+                    for (channel, profile, words) in dirty]
+        return dirty, commands
+
+    def updateShadow(self, dirty):
+        """Records that the (channel, profile, words) entries returned by
+        profileCommands have been written"""
+        for (channel, profile, words) in dirty:
+            self.shadow.update(channel, profile, words)
+
+    def _profileToWords(self, freq, phase, amp):
+        """Converts a frequency (Hz), phase (degrees) and amplitude (full-scale)
+        to frequency, phase and amplitude words"""
+        return self.conversion.toWords(freq, phase, amp)
+
+    def _checkProfileWords(self, channel, profile, freq, phase, amp):
+        if channel < 0 or channel >= self.nChannels or not isinstance(channel, int):
+            raise ValueError("DDS channel should be an integer between 0 and {}".format(
+                self.nChannels - 1))
+        if profile < 0 or profile >= self.nProfiles or not isinstance(profile, int):
+            raise ValueError("DDS profile should be an integer between 0 and {}".format(
+                self.nProfiles - 1))
+        if amp > 0x3fff or amp < 0 or not isinstance(amp, int):
+            raise ValueError("DDS amplitude word should be an integer between 0 and 0x3fff")
+        if phase > 0xffff or phase < 0 or not isinstance(phase, int):
+            raise ValueError("DDS phase word should be an integer between 0 and 0xffff")
+        if freq < 0 or freq > 0xffffffff or not isinstance(freq, int):
+            raise ValueError("DDS frequency word should be an integer between 0 and 0xffffffff")
+
+    def get_profile(self, channel, profile):
+        """Returns the (freq, phase, amp) last written to a profile, in Hz,
+        degrees and full-scale, without communicating with the device.
+        Returns None if the profile has not been written since connecting"""
+        words = self.shadow.get(channel, profile)
+        if words is None:
+            return None
+        return tuple(float(x) for x in self.conversion.fromWords(*words))
+
+    def get_shadow_stats(self):
+        """Returns the number of profile writes skipped (hits) and sent (misses)"""
+        return self.shadow.getStats()
+
+    def get_lsb_freq(self):
+        return self.lsbFreq
+
+    def convertToWords(self, freq, phase=0.0, amp=1.0):
+        """Converts frequencies (Hz), phases (degrees) and amplitudes
+        (full-scale), scalars or arrays, to frequency, phase and amplitude
+        words. Raises ValueError if any point is out of range"""
+        return self.conversion.toWords(freq, phase, amp)
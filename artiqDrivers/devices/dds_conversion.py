@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class DdsConversion:
+    """Converts frequencies (Hz), phases (degrees) and amplitudes (full-scale)
+    to and from the frequency, phase and amplitude words of a 32 bit FTW, 16 bit
+    POW, 14 bit ASF DDS (AD9910 style) with a given clock frequency.
+
+    All conversions accept scalars or arrays. Array inputs are converted with a
+    single NumPy call and return int64 arrays, scalar inputs return ints. Any
+    out of range point raises a ValueError before anything is returned, so
+    whole scans can be checked up front."""
+    maxFreqWord = 0xffffffff
+    maxPhaseWord = 0xffff
+    maxAmpWord = 0x3fff
+
+    # Highest usable output frequency as a fraction of the Nyquist frequency,
+    # beyond which the reconstruction filter attenuates the output
+    nyquistFraction = 0.9
+
+    lsbAmp = 1.0 / maxAmpWord # 0x3fff is maximum amplitude
+    lsbPhase = 360.0 / (maxPhaseWord + 1) # Degrees per LSB.
+
+    def __init__(self, clockFreq):
+        self.clockFreq = clockFreq
+        self.lsbFreq = clockFreq / (2**32)
+        self.maxFreq = self.nyquistFraction * clockFreq / 2
+
+    @classmethod
+    def fromLsbFreq(cls, lsbFreq):
+        """Construct from the frequency LSB, as returned by get_lsb_freq()"""
+        return cls(lsbFreq * 2**32)
+
+    @staticmethod
+    def _result(words):
+        if np.ndim(words) == 0:
+            return int(words)
+        return words
+
+    def freqToWord(self, freq):
+        freq = np.asarray(freq, dtype=float)
+        if not np.all((freq >= 0) & (freq <= self.maxFreq)):
+            raise ValueError("DDS frequency must be between 0 and {:.0f} MHz".format(
+                self.maxFreq / 1e6))
+        return self._result(np.round(freq / self.lsbFreq).astype(np.int64))
+
+    def phaseToWord(self, phase):
+        phase = np.asarray(phase, dtype=float)
+        if not np.all(np.isfinite(phase)):
+            raise ValueError("DDS phase must be finite")
+        words = np.round((phase % 360.0) / self.lsbPhase).astype(np.int64)
+        # Phases just below 360 degrees round up to a full turn
+        return self._result(words % (self.maxPhaseWord + 1))
+
+    def ampToWord(self, amp):
+        amp = np.asarray(amp, dtype=float)
+        if not np.all((amp >= 0) & (amp <= 1)):
+            raise ValueError("DDS amplitude must be between 0 and 1")
+        return self._result(np.round(amp / self.lsbAmp).astype(np.int64))
+
+    def toWords(self, freq, phase=0.0, amp=1.0):
+        """Returns the (freq, phase, amp) words. All arguments are broadcast
+        against each other"""
+        freq, phase, amp = np.broadcast_arrays(freq, phase, amp)
+        return (self.freqToWord(freq), self.phaseToWord(phase),
+                self.ampToWord(amp))
+
+    def fromWords(self, freqWord, phaseWord, ampWord):
+        """Returns the (freq, phase, amp) actually produced by the given words"""
+        return (np.asarray(freqWord) * self.lsbFreq,
+                np.asarray(phaseWord) * self.lsbPhase,
+                np.asarray(ampWord) * self.lsbAmp)
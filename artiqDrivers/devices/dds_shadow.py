@@ -0,0 +1,39 @@
+class ProfileShadow:
+    """Host-side copy of the (frequency, phase, amplitude) words last written to
+    each profile of a DDS, used to skip writes which would not change anything.
+
+    Entries are None until they are first written, or after invalidate(), so
+    that the first write to each profile always goes to the device."""
+    def __init__(self, nChannels, nProfiles=8):
+        self.nChannels = nChannels
+        self.nProfiles = nProfiles
+        self.hits = 0
+        self.misses = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget all profiles, e.g. after the device has been reset"""
+        self.words = [[None]*self.nProfiles for _ in range(self.nChannels)]
+
+    def isDirty(self, channel, profile, words):
+        """Returns True if writing words to the profile would change it, and
+        updates the hit/miss counters accordingly"""
+        if self.words[channel][profile] == tuple(words):
+            self.hits += 1
+            return False
+        self.misses += 1
+        return True
+
+    def update(self, channel, profile, words):
+        self.words[channel][profile] = tuple(words)
+
+    def get(self, channel, profile):
+        """Returns the (freq, phase, amp) words of a profile, or None if unknown"""
+        return self.words[channel][profile]
+
+    def getStats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
@@ -4,6 +4,7 @@ import argparse
 import sys
 
 from artiqDrivers.devices.coherentDds.driver import CoherentDds, CoherentDdsSim
+from artiqDrivers.devices.coherentDds.pipeline import CoherentDdsPipeline
 from sipyco.pc_rpc import simple_server_loop
 from sipyco.common_args import simple_network_args, init_logger_from_args
 from oxart.tools import add_common_args
@@ -23,6 +24,13 @@ def get_argparser():
     parser.add_argument("--disable-coherence", action="append",
                         help="disable coherent switching (=no phase glitches) "
                              "for a given channel")
+    parser.add_argument("--ascii", action="store_true",
+                        help="always use the ASCII protocol, even if the "
+                             "firmware supports the binary protocol")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="queue profile writes and phase resets and write "
+                             "them in the background; use the flush() and "
+                             "barrier() RPCs to synchronise")
 
     simple_network_args(parser, 4000)
     add_common_args(parser)
@@ -47,11 +55,17 @@ def main():
         sys.exit(1)
 
     if args.simulation:
-        dev = CoherentDdsSim()
+        dev = CoherentDdsSim(clockFreq=args.clockfreq,
+                             internal_clock=args.internal_clock,
+                             incoherent_channels=incoherent_channels,
+                             binary=not args.ascii)
     else:
         dev = CoherentDds(addr=args.device, clockFreq=args.clockfreq,
                                     internal_clock=args.internal_clock,
-                                    incoherent_channels=incoherent_channels)
+                                    incoherent_channels=incoherent_channels,
+                                    binary=not args.ascii)
+    if args.pipeline:
+        dev = CoherentDdsPipeline(dev)
 
     simple_server_loop({"coherentDds": dev}, args.bind, args.port)
 
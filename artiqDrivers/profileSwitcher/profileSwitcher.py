@@ -3,38 +3,156 @@ from artiq.language.units import *
 import numpy as np
 
 
+def transitionTable(nLines, sameFrequency=()):
+    """Precomputes, for every (current, target) pair of the 2**nLines profiles,
+    the profile lines which differ, in the order in which to switch them.
+
+    Switching one line at a time walks a Gray-code path from the current to the
+    target profile, so every intermediate profile is briefly selected. The
+    lines are ordered so that as many intermediate profiles as possible have
+    the same frequency as the current profile (and otherwise as the target),
+    according to sameFrequency, a list of groups of profiles known to share a
+    frequency; an intermediate profile at another frequency scrambles the
+    phase.
+
+    Returns (counts, lines): counts[current*2**nLines + target] is the number
+    of lines to switch, and lines[(current*2**nLines + target)*nLines + k] the
+    k-th line to switch, padded with -1"""
+    nStates = 2**nLines
+    group = list(range(nStates))
+    for i, profiles in enumerate(sameFrequency):
+        for profile in profiles:
+            group[profile] = nStates + i
+
+    counts = []
+    lines = []
+    for current in range(nStates):
+        for target in range(nStates):
+            remaining = [i for i in range(nLines) if (current ^ target) & (1 << i)]
+            order = []
+            state = current
+            while remaining:
+                # Greedily pick the line whose intermediate profile is safest
+                line = max(remaining, key=lambda i: (
+                    group[state ^ (1 << i)] == group[current],
+                    group[state ^ (1 << i)] == group[target]))
+                remaining.remove(line)
+                order.append(line)
+                state ^= 1 << line
+            counts.append(len(order))
+            lines.extend(order + [-1]*(nLines - len(order)))
+    return counts, lines
+
+
 class ProfileSwitcher:
     kernel_invariants = {"interProfileDelay_mu",
                          "finalDelay_mu",
                          "nProfiles",
-                         "profiles"}
-    def __init__(self, dmgr, profile_lines, interProfileDelay=200*ns, finalDelay=200*ns):
+                         "nStates",
+                         "profiles",
+                         "transitionCounts",
+                         "transitionLines",
+                         "timestamped",
+                         "skew_mu"}
+    def __init__(self, dmgr, profile_lines, interProfileDelay=200*ns, finalDelay=200*ns,
+                 sameFrequency=(), timestamped=False, skew_mu=None):
         """interProfileDelay is the delay to insert between switching profile lines.
         finalDelay is the delay to add after all profile changes have occured.
-        Profile line order is [p0, p1, p2]"""
+        Profile line order is [p0, p1, p2]
+        sameFrequency is an optional list of groups of profiles which share a
+        frequency, used to order the line changes (see transitionTable)
+        If timestamped is True all lines change at the same RTIO timestamp
+        instead, plus an optional per-line skew_mu calibration (a list of
+        non-negative machine unit delays, one per line, at most finalDelay), and
+        every switch takes exactly finalDelay"""
         self.core = dmgr.get("core")
-        
+
         self.nProfiles = len(profile_lines)
+        self.nStates = 2**self.nProfiles
         self.profiles = []
         for ii, p0 in enumerate(profile_lines):
             self.profiles.append(dmgr.get(p0))
-        self.interProfileDelay_mu = interProfileDelay
-        self.finalDelay_mu = finalDelay
-        
+        self.interProfileDelay_mu = self.core.seconds_to_mu(interProfileDelay)
+        self.finalDelay_mu = self.core.seconds_to_mu(finalDelay)
+
+        self.timestamped = timestamped
+        if skew_mu is None:
+            skew_mu = [0]*self.nProfiles
+        if len(skew_mu) != self.nProfiles:
+            raise ValueError("skew_mu needs one entry per profile line")
+        if any(s < 0 or s > self.finalDelay_mu for s in skew_mu):
+            raise ValueError("Profile line skews must be between 0 and finalDelay")
+        self.skew_mu = [int(s) for s in skew_mu]
+
+        self.transitionCounts, self.transitionLines = transitionTable(
+            self.nProfiles, sameFrequency)
+        # Profile the lines currently select, or -1 if unknown
+        self.currentProfile = -1
+
+    def forgetProfile(self):
+        """Mark the line state as unknown, e.g. after the lines have been driven
+        by something else, so that the next switch sets every line"""
+        self.currentProfile = -1
 
-        
     @kernel
     def setProfile(self, profile):
-        if profile < 0 or profile > (2**self.nProfiles)-1:
+        """Switches to 'profile', changing only the lines which differ from the
+        current profile.
+        In timestamped mode all of them change at once (see setProfileTimestamped).
+        Otherwise each line change after the first costs interProfileDelay, and
+        finalDelay is added after the last one. Nothing happens (and no time
+        passes) if the profile is already selected"""
+        if profile < 0 or profile > self.nStates-1:
             raise InvalidProfile()
+        if self.timestamped:
+            self.setProfileTimestamped(profile)
+            return
+
+        if self.currentProfile < 0:
+            # Line state unknown, so set every line
+            for i in range(self.nProfiles):
+                if i > 0:
+                    delay_mu(self.interProfileDelay_mu)
+                self._setLine(i, profile)
+        else:
+            transition = self.currentProfile*self.nStates + profile
+            count = self.transitionCounts[transition]
+            if count == 0:
+                return
+            for k in range(count):
+                if k > 0:
+                    delay_mu(self.interProfileDelay_mu)
+                self._setLine(self.transitionLines[transition*self.nProfiles + k], profile)
+        self.currentProfile = profile
+        delay_mu(self.finalDelay_mu)
 
+    @kernel
+    def setProfileTimestamped(self, profile):
+        """Switches to 'profile' with every changed line set at the current
+        RTIO timestamp plus its skew_mu, so no intermediate profile is selected.
+        The cursor is left exactly finalDelay after the start, whether or not
+        anything changed, so the switch has a fixed latency"""
+        if profile < 0 or profile > self.nStates-1:
+            raise InvalidProfile()
+
+        t_start = now_mu()
+        changed = self.currentProfile ^ profile
+        if self.currentProfile < 0:
+            # Line state unknown, so set every line
+            changed = self.nStates - 1
         for i in range(self.nProfiles):
-            if profile & 1<<i:
-                self.profiles[i].on()
-            else:
-                self.profiles[i].off()
-            delay(self.interProfileDelay_mu)
-        delay(self.finalDelay_mu)
+            if changed & (1 << i):
+                at_mu(t_start + self.skew_mu[i])
+                self._setLine(i, profile)
+        self.currentProfile = profile
+        at_mu(t_start + self.finalDelay_mu)
+
+    @kernel
+    def _setLine(self, line, profile):
+        if profile & (1 << line):
+            self.profiles[line].on()
+        else:
+            self.profiles[line].off()
 
 
 class InvalidProfile(Exception):
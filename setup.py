@@ -20,6 +20,7 @@ setup(name='artiqDrivers',
         "console_scripts": scripts,
     },
     install_requires = [
-        'pyserial>=3'
+        'pyserial>=3',
+        'numpy'
     ]
 )